@@ -1,7 +1,12 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class BotConfig(AppConfig):
     name = 'bot'
+
+    def ready(self):
+        from .indexes import create_indexes
+        post_migrate.connect(create_indexes, sender=self)
@@ -0,0 +1,71 @@
+import base64
+import json
+import zlib
+
+from django.conf import settings
+from django.db import models
+
+
+class CompressedJSONField(models.TextField):
+    """CompressedJSONField
+
+    Stores a json serializable value as zlib compressed json in a text column, base64 encoded
+    behind a 'z:' marker. The value is compressed when saved and decompressed when loaded, so
+    the model attribute always holds the decoded value.
+
+    The column stays a text column, so it replaces a text column of plain json without
+    changing its type, and plain json values written before are still loaded as is.
+
+    Parameters
+    ----------
+    level: int
+        zlib compression level
+    """
+    PREFIX = 'z:'
+
+    def __init__(self, *args, **kwargs):
+        self.level = kwargs.pop('level', 6)
+        super(CompressedJSONField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CompressedJSONField, self).deconstruct()
+        if self.level != 6:
+            kwargs['level'] = self.level
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return None
+        if not value:
+            # Blank rows of the former text column
+            return {}
+        if value.startswith(self.PREFIX):
+            data = zlib.decompress(base64.b64decode(value[len(self.PREFIX):]))
+            return json.loads(data.decode('utf-8'))
+        return json.loads(value)
+
+    def to_python(self, value):
+        # Serialized fixtures hold the json value itself
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        data = zlib.compress(json.dumps(value).encode('utf-8'), self.level)
+        return self.PREFIX + base64.b64encode(data).decode('ascii')
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+
+def PayloadField(**kwargs):
+    """PayloadField
+
+    Field for storing webhook payloads, depending on BOT_MESSAGE_PAYLOAD_STORAGE:
+     - 'zlib': compressed json in a text column (see CompressedJSONField)
+     - 'json': native jsonb column, Postgres only
+    """
+    if settings.BOT_MESSAGE_PAYLOAD_STORAGE == 'json':
+        from django.contrib.postgres.fields import JSONField
+        return JSONField(**kwargs)
+    return CompressedJSONField(**kwargs)
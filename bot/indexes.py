@@ -0,0 +1,92 @@
+"""Database specific indexes
+
+Django can't declare partial or trigram indexes on models, so the following are created with raw
+SQL after migrating, on the databases that support them.
+"""
+import logging
+
+from django.db import (
+    DatabaseError,
+    connections,
+    router,
+)
+
+from .models import (
+    BotMessage,
+    BotUser,
+)
+
+logger = logging.getLogger(__name__)
+
+# (model, name, columns, condition)
+PARTIAL_INDEXES = (
+    # MessageLogger.log_delivery: outbound messages of a user not yet delivered upto a watermark
+    (
+        BotMessage,
+        'bot_botmessage_undelivered',
+        ('bot_id', 'timestamp'),
+        "received = %(false)s AND delivered_time IS NULL",
+    ),
+    # MessageLogger.log_read: outbound messages of a user delivered but not yet read upto a watermark
+    (
+        BotMessage,
+        'bot_botmessage_unread',
+        ('bot_id', 'timestamp'),
+        "received = %(false)s AND delivered_time IS NOT NULL AND read_time IS NULL",
+    ),
+)
+
+# (model, name, column), Postgres only
+TRIGRAM_INDEXES = (
+    # search_bot_users: fuzzy name matches
+    (BotUser, 'bot_botuser_search_name_trgm', '_search_name'),
+)
+
+SUPPORTED_VENDORS = {
+    'postgresql': {'false': 'false'},
+    'sqlite': {'false': '0'},
+}
+
+
+def create_indexes(sender, using='default', **kwargs):
+    """create_indexes
+
+    post_migrate receiver that creates PARTIAL_INDEXES and TRIGRAM_INDEXES if they don't exist yet.
+    """
+    connection = connections[using]
+    literals = SUPPORTED_VENDORS.get(connection.vendor)
+    if literals is None:
+        return
+
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        tables = connection.introspection.table_names(cursor)
+
+        def can_index(model):
+            return model._meta.db_table in tables and router.allow_migrate_model(using, model)
+
+        for model, name, columns, condition in PARTIAL_INDEXES:
+            if can_index(model):
+                cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s) WHERE %s" % (
+                    qn(name),
+                    qn(model._meta.db_table),
+                    ', '.join(qn(column) for column in columns),
+                    condition % literals,
+                ))
+
+        if connection.vendor != 'postgresql':
+            return
+
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except DatabaseError:
+            logger.warning("Couldn't enable pg_trgm, skipping trigram indexes", exc_info=True)
+            return
+
+        for model, name, column in TRIGRAM_INDEXES:
+            if can_index(model):
+                cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s gin_trgm_ops)" % (
+                    qn(name),
+                    qn(model._meta.db_table),
+                    qn(column),
+                ))
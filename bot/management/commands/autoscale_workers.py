@@ -0,0 +1,40 @@
+from celery import current_app
+from django.core.management.base import BaseCommand
+
+from ...utils.autoscale import ConcurrencyController
+
+
+class Command(BaseCommand):
+    """autoscale_workers
+
+    Adapts the pool size of the workers of a queue to its depth and latency, see
+    ConcurrencyController.
+    """
+    help = "Grows and shrinks the worker pools of a queue based on its depth and latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue', help="Queue to watch, e.g. replies.")
+        parser.add_argument('--destination', action='append',
+                            help="Node name of a worker to resize, e.g. replies@host. Defaults to all the workers consuming the queue.")
+        parser.add_argument('--min', dest='min_size', type=int, default=1, help="Min pool size per worker.")
+        parser.add_argument('--max', dest='max_size', type=int, default=8, help="Max pool size per worker.")
+        parser.add_argument('--target-latency', dest='target_latency', type=float, default=5.0,
+                            help="Seconds a task may wait in the queue.")
+        parser.add_argument('--step', type=int, default=1)
+        parser.add_argument('--hysteresis', type=float, default=0.5)
+        parser.add_argument('--cooldown', type=float, default=30.0)
+        parser.add_argument('--interval', type=float, default=5.0, help="Seconds between samples.")
+
+    def handle(self, *args, **options):
+        controller = ConcurrencyController(
+            current_app,
+            options['queue'],
+            destination=options['destination'],
+            min_size=options['min_size'],
+            max_size=options['max_size'],
+            target_latency=options['target_latency'],
+            step=options['step'],
+            hysteresis=options['hysteresis'],
+            cooldown=options['cooldown'],
+        )
+        controller.run(interval=options['interval'])
@@ -0,0 +1,72 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...utils.intents import IntentMatcher
+from ...utils.text import normalize
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def make_word(rng):
+    return ''.join(rng.choice(LETTERS) for _ in range(rng.randint(3, 9)))
+
+
+class Command(BaseCommand):
+    """bench_intents
+
+    Benchmarks IntentMatcher against trying each rule in turn, on randomly generated keyword and
+    regex rules and texts. A tenth of the rules are regexes.
+    """
+    help = "Benchmarks intent matching against trying each rule in turn."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=1000, help="Number of rules.")
+        parser.add_argument('--texts', type=int, default=2000, help="Number of texts to match.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        matcher = IntentMatcher()
+        rules = []
+        for i in range(options['rules']):
+            priority = rng.randint(0, 10)
+            if i % 10 == 0:
+                pattern = r'%s \d+' % make_word(rng)
+                matcher.regex('intent-%d' % i, pattern, priority=priority)
+                rules.append((re.compile(pattern, re.UNICODE), 'intent-%d' % i, priority))
+            else:
+                keyword = ' '.join(make_word(rng) for _ in range(rng.randint(1, 2)))
+                matcher.keyword('intent-%d' % i, keyword, priority=priority)
+                rules.append((re.compile(r'\b%s\b' % re.escape(keyword), re.UNICODE), 'intent-%d' % i, priority))
+
+        vocabulary = [make_word(rng) for _ in range(200)]
+        texts = [
+            ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 20))) + ' %d' % rng.randint(0, 99)
+            for _ in range(options['texts'])
+        ]
+
+        start = time.time()
+        matcher.compile()
+        compiled = time.time() - start
+
+        start = time.time()
+        for text in texts:
+            matcher.match(text)
+        matched = time.time() - start
+
+        start = time.time()
+        for text in texts:
+            text = normalize(text)
+            best = None
+            for regex, intent, priority in rules:
+                if regex.search(text) and (best is None or priority > best[1]):
+                    best = (intent, priority)
+        naive = time.time() - start
+
+        n = len(texts)
+        self.stdout.write("compile:  %d rules in %.2fs" % (len(rules), compiled))
+        self.stdout.write("matcher:  %d texts in %.2fs (%.0f texts/s)" % (n, matched, n / matched))
+        self.stdout.write("per rule: %d texts in %.2fs (%.0f texts/s)" % (n, naive, n / naive))
@@ -0,0 +1,74 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+
+from ...models import BotMessage
+from ...tasks import log_payload
+from ...utils.consume import log_batch
+
+
+def make_payload(run, i):
+    timestamp = int(time.time() * 1000)
+    return json.dumps({
+        'object': 'page',
+        'entry': [{
+            'id': 'bench-page',
+            'time': timestamp,
+            'messaging': [{
+                'sender': {'id': 'bench-%d' % (i % 100)},
+                'recipient': {'id': 'bench-page'},
+                'timestamp': timestamp,
+                'message': {'mid': 'bench-mid-%s-%d' % (run, i), 'seq': i, 'text': 'hello %d' % i},
+            }],
+        }],
+    })
+
+
+class Command(BaseCommand):
+    """bench_logging
+
+    Benchmarks logging tasks one by one, as the log_payload task does, against logging them in
+    batches, as LogBatchConsumer does. Both run in process, so the numbers are the ceiling of the
+    database side of logging without broker overhead.
+
+    The benchmark messages are deleted afterwards. Since this writes to and deletes from the
+    configured database, it only runs with DEBUG on, or with --force.
+    """
+    help = "Benchmarks per task against batched logging of payloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=2000, help="Number of tasks to log.")
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=100,
+                            help="Tasks per batch.")
+        parser.add_argument('--force', action='store_true',
+                            help="Run even though DEBUG is off, e.g. against a staging database.")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("DEBUG is off, this may be a production database. Use --force to run anyway.")
+
+        n, batch_size = options['tasks'], options['batch_size']
+        try:
+            payloads = [make_payload('task', i) for i in range(n)]
+            start = time.time()
+            for data in payloads:
+                log_payload(data)
+            per_task = time.time() - start
+
+            payloads = [make_payload('batch', i) for i in range(n)]
+            start = time.time()
+            for i in range(0, n, batch_size):
+                log_batch(payloads[i:i + batch_size])
+            batched = time.time() - start
+        finally:
+            BotMessage.objects.filter(bot_id__startswith='bench-', mid__startswith='bench-mid-').delete()
+
+        self.stdout.write("per task: %d tasks in %.2fs (%.0f tasks/s)" % (n, per_task, n / per_task))
+        self.stdout.write("batched:  %d tasks in %.2fs (%.0f tasks/s), batches of %d" % (
+            n, batched, n / batched, batch_size
+        ))
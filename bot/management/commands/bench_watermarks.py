@@ -0,0 +1,83 @@
+from datetime import timedelta
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from ...models import BotMessage
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """bench_watermarks
+
+    Benchmarks marking messages as delivered row by row against a single set-based UPDATE,
+    as done by MessageLogger.log_delivery.
+
+    Run it once per database, e.g. against SQLite locally and against Postgres by setting
+    DATABASE_URL. All rows are created inside a transaction that is rolled back.
+    """
+    help = "Benchmarks row-by-row against bulk delivery/read watermark updates."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+                            help="Database alias to benchmark against.")
+        parser.add_argument('--sizes', default='10,100,1000,10000',
+                            help="Comma separated conversation sizes (outbound messages per user).")
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Number of runs per size, the best one is reported.")
+
+    def handle(self, *args, **options):
+        using = options['database']
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        self.stdout.write("%10s %14s %14s %10s" % ('messages', 'loop (ms)', 'update (ms)', 'speedup'))
+        for size in sizes:
+            loop_time = min(self.run(using, size, self.mark_loop) for _ in range(options['repeat']))
+            update_time = min(self.run(using, size, self.mark_update) for _ in range(options['repeat']))
+            self.stdout.write("%10d %14.2f %14.2f %9.1fx" % (
+                size, loop_time * 1000, update_time * 1000, loop_time / max(update_time, 1e-9)
+            ))
+
+    def run(self, using, size, mark):
+        """run
+
+        Seeds a conversation of the given size and times marking it as delivered.
+        """
+        elapsed = []
+        try:
+            with transaction.atomic(using=using):
+                bot_id = 'bench-%d' % size
+                now = timezone.now()
+                BotMessage.objects.using(using).bulk_create([
+                    BotMessage(bot_id=bot_id, timestamp=now - timedelta(seconds=i), received=False)
+                    for i in range(size)
+                ], batch_size=500)
+
+                qs = BotMessage.objects.using(using).filter(
+                    bot_id=bot_id,
+                    received=False,
+                    delivered_time__isnull=True,
+                    timestamp__lte=now,
+                )
+
+                start = time.time()
+                mark(qs, now)
+                elapsed.append(time.time() - start)
+                raise Rollback
+        except Rollback:
+            pass
+
+        return elapsed[0]
+
+    def mark_loop(self, qs, watermark):
+        for bm in qs:
+            bm.delivered_time = watermark
+            bm.save()
+
+    def mark_update(self, qs, watermark):
+        return qs.update(delivered_time=watermark)
@@ -0,0 +1,21 @@
+from celery import current_app
+from django.core.management.base import BaseCommand
+
+from ...utils.consume import LogBatchConsumer
+
+
+class Command(BaseCommand):
+    """consume_logs
+
+    Consumes log_payload tasks from the logging queue in batches, in place of a celery worker.
+    """
+    help = "Consumes log_payload tasks in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=100,
+                            help="Max number of tasks logged per transaction.")
+        parser.add_argument('--timeout', type=float, default=1.0,
+                            help="Max seconds to wait for a batch to fill up.")
+
+    def handle(self, *args, **options):
+        LogBatchConsumer(current_app, batch_size=options['batch_size'], timeout=options['timeout']).run()
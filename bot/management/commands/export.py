@@ -0,0 +1,202 @@
+from datetime import (
+    date,
+    datetime,
+)
+import csv
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from django.db import connections
+from django.utils import six
+from django.utils.dateparse import parse_datetime
+
+from ...models import (
+    BotMessage,
+    BotUser,
+)
+
+# model name -> (model, time field)
+MODELS = {
+    'messages': (BotMessage, 'timestamp'),
+    'users': (BotUser, 'created_at'),
+}
+
+
+def field_names(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def to_record(obj):
+    record = {}
+    for name in field_names(obj.__class__):
+        value = getattr(obj, name)
+        if isinstance(value, (date, datetime)):
+            value = value.isoformat()
+        record[name] = value
+    return record
+
+
+def ndjson_line(record, names):
+    return json.dumps(record).encode('utf-8') + b'\n'
+
+
+def csv_line(record, names):
+    values = []
+    for name in names:
+        value = record[name]
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        if six.PY2 and isinstance(value, six.text_type):
+            value = value.encode('utf-8')
+        values.append(value)
+
+    f = io.BytesIO() if six.PY2 else io.StringIO()
+    csv.writer(f).writerow(values)
+    line = f.getvalue()
+    return line if isinstance(line, bytes) else line.encode('utf-8')
+
+
+def part_path(path, part):
+    """part_path
+
+    Inserts the part number before the extensions of path, e.g. out.ndjson.gz -> out.part1.ndjson.gz
+    """
+    directory, filename = os.path.split(path)
+    name, dot, extensions = filename.partition('.')
+    return os.path.join(directory, '%s.part%d%s%s' % (name, part, dot, extensions))
+
+
+def export_range(options, lower, upper, path):
+    """export_range
+
+    Exports the rows with lower < pk <= upper (either bound can be None) to path, reading them
+    in keyset ordered chunks so memory stays flat.
+
+    Returns
+    -------
+    (path, count, seconds): tuple
+    """
+    # Connections inherited from the parent process can't be shared
+    connections.close_all()
+
+    model, time_field = MODELS[options['model']]
+    names = field_names(model)
+    write_line = csv_line if options['format'] == 'csv' else ndjson_line
+
+    qs = model.objects.order_by('pk')
+    if options['start']:
+        qs = qs.filter(**{time_field + '__gte': options['start']})
+    if options['end']:
+        qs = qs.filter(**{time_field + '__lt': options['end']})
+    if options['bot_id']:
+        qs = qs.filter(bot_id=options['bot_id'])
+    if upper is not None:
+        qs = qs.filter(pk__lte=upper)
+
+    start = time.time()
+    count = 0
+    opener = gzip.open if options['gzip'] else io.open
+    with opener(path, 'wb') as f:
+        if options['format'] == 'csv':
+            f.write(csv_line(dict(zip(names, names)), names))
+
+        last = lower
+        while True:
+            chunk_qs = qs if last is None else qs.filter(pk__gt=last)
+            chunk = list(chunk_qs[:options['chunk_size']])
+            if not chunk:
+                break
+
+            for obj in chunk:
+                f.write(write_line(to_record(obj), names))
+            count += len(chunk)
+            last = chunk[-1].pk
+
+    return path, count, time.time() - start
+
+
+def export_range_star(args):
+    return export_range(*args)
+
+
+class Command(BaseCommand):
+    """export
+
+    Streams BotMessages or BotUsers to newline delimited json or csv files.
+
+    Rows are read in primary key ordered chunks, so memory stays flat regardless of the table size.
+    With --workers, the primary key range is split into that many parts exported in parallel
+    processes, each to its own file.
+    """
+    help = "Exports messages or users to ndjson or csv."
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(MODELS))
+        parser.add_argument('output', help="Output path, each worker writes a .partN file.")
+        parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+        parser.add_argument('--gzip', action='store_true', help="Gzip the output.")
+        parser.add_argument('--start', help="Only rows at or after this ISO datetime.")
+        parser.add_argument('--end', help="Only rows before this ISO datetime.")
+        parser.add_argument('--bot-id', dest='bot_id', help="Only rows of this user.")
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=2000,
+                            help="Rows read per query.")
+        parser.add_argument('--workers', type=int, default=1, help="Number of export processes.")
+
+    def handle(self, *args, **options):
+        for name in ('start', 'end'):
+            if options[name]:
+                options[name] = parse_datetime(options[name])
+                if options[name] is None:
+                    raise CommandError("--%s must be an ISO datetime" % name)
+
+        workers = max(options['workers'], 1)
+        if workers == 1:
+            parts = [(options, None, None, options['output'])]
+        else:
+            bounds = [None] + self.split_points(options, workers) + [None]
+            parts = [
+                (options, bounds[i], bounds[i + 1], part_path(options['output'], i))
+                for i in range(len(bounds) - 1)
+            ]
+
+        start = time.time()
+        if len(parts) == 1:
+            results = [export_range(*parts[0])]
+        else:
+            pool = multiprocessing.Pool(len(parts))
+            try:
+                results = pool.map(export_range_star, parts)
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - start
+
+        total = 0
+        for path, count, seconds in results:
+            total += count
+            self.stdout.write("%s: %d rows in %.1fs (%.0f rows/s)" % (path, count, seconds, count / max(seconds, 1e-9)))
+        self.stdout.write("Exported %d rows in %.1fs (%.0f rows/s)" % (total, elapsed, total / max(elapsed, 1e-9)))
+
+    def split_points(self, options, workers):
+        """split_points
+
+        Primary keys splitting the table into about equally sized parts.
+        """
+        model, _ = MODELS[options['model']]
+        pks = model.objects.order_by('pk').values_list('pk', flat=True)
+        count = pks.count()
+
+        points = []
+        for i in range(1, workers):
+            pk = list(pks[i * count // workers:i * count // workers + 1])
+            if pk and (not points or pk[0] != points[-1]):
+                points.append(pk[0])
+        return points
@@ -0,0 +1,99 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from ... import views
+from ...tasks import (
+    handle_payload,
+    log_payload,
+)
+from ...utils.capture import (
+    iter_segments,
+    segment_paths,
+)
+
+
+class Command(BaseCommand):
+    """replay_webhooks
+
+    Replays webhook requests captured with BOT_WEBHOOK_CAPTURE_DIR, for benchmarking.
+
+    Requests of all the given segments are replayed in the order they were received, with
+    recorded timing relative to the first one, across segments and capturing processes.
+
+    Targets:
+        handle: handle_payload only, run in process
+        log: log_payload only, run in process
+        both: handle_payload then log_payload, as the view queues them but without the broker
+        view: the webhook view itself, signature verification and broker included
+
+    Note that handling sends replies through the Graph API, so replay against a test page.
+    """
+    help = "Replays captured webhook requests through the handler, the logger or the view."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help="Segment files or capture directories.")
+        parser.add_argument('--target', choices=['handle', 'log', 'both', 'view'], default='both')
+        parser.add_argument('--timing', choices=['fast', 'recorded'], default='fast',
+                            help="Replay as fast as possible or with the recorded gaps.")
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help="Speed up factor of recorded timing.")
+        parser.add_argument('--limit', type=int, help="Max number of requests to replay.")
+
+    def handle(self, *args, **options):
+        replay = getattr(self, 'replay_%s' % options['target'])
+        factory = RequestFactory()
+
+        latencies = []
+        first_received = None
+        start = time.time()
+        for received_at, signature, body in iter_segments(segment_paths(options['paths'])):
+            if options['limit'] is not None and len(latencies) >= options['limit']:
+                break
+
+            if options['timing'] == 'recorded':
+                if first_received is None:
+                    first_received = received_at
+                delay = (received_at - first_received) / options['speed'] - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            request_start = time.time()
+            replay(factory, signature.decode('ascii'), body)
+            latencies.append(time.time() - request_start)
+
+        elapsed = time.time() - start
+        self.report(latencies, elapsed)
+
+    def replay_handle(self, factory, signature, body):
+        handle_payload(body)
+
+    def replay_log(self, factory, signature, body):
+        log_payload(body)
+
+    def replay_both(self, factory, signature, body):
+        handle_payload(body)
+        log_payload(body)
+
+    def replay_view(self, factory, signature, body):
+        request = factory.post('/webhook/', data=body, content_type='application/json',
+                               HTTP_X_HUB_SIGNATURE=signature)
+        views.webhook(request)
+
+    def report(self, latencies, elapsed):
+        if not latencies:
+            self.stdout.write("No requests replayed.")
+            return
+
+        latencies.sort()
+
+        def percentile(p):
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+        self.stdout.write("Replayed %d requests in %.2fs (%.1f requests/s)" % (
+            len(latencies), elapsed, len(latencies) / max(elapsed, 1e-9)
+        ))
+        self.stdout.write("Latency p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms" % (
+            percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1] * 1000
+        ))
@@ -1,24 +1,64 @@
 from __future__ import unicode_literals
 
+import logging
 import os
-
-from django.db import models
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import (
+    IntegrityError,
+    models,
+    transaction,
+)
+from django.db.models import (
+    Case,
+    F,
+    Q,
+    Value,
+    When,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from messenger import (
     Sender,
     UserProfile,
 )
 
+from .fields import PayloadField
+from .utils.text import normalize
+
 token = os.environ.get('PAGE_ACCESS_TOKEN')
+logger = logging.getLogger(__name__)
 
 
-def user_field(f):
-    def decorated(*args, **kwargs):
-        try:
-            return f(*args, **kwargs)
-        except:
-            return ''
-    return decorated
+class BotUserQuerySet(models.QuerySet):
+    def stale_profiles(self, max_age=None):
+        """stale_profiles
+
+        Users whose profile snapshot was never fetched or is older than max_age
+        (defaults to BOT_USER_PROFILE_TTL).
+        """
+        if max_age is None:
+            max_age = timedelta(seconds=settings.BOT_USER_PROFILE_TTL)
+
+        now = timezone.now()
+        threshold = now - max_age
+        return self.filter(
+            Q(profile_fetched_at__isnull=True) | Q(profile_fetched_at__lt=threshold)
+        ).filter(
+            Q(profile_retry_at__isnull=True) | Q(profile_retry_at__lte=now)
+        )
+
+    def unreachable(self):
+        """unreachable
+
+        Users whose profile has failed to load BOT_USER_PROFILE_MAX_FAILURES times in a row,
+        usually because they blocked the page or deleted their account. These are candidates
+        for cleanup.
+        """
+        return self.filter(profile_failures__gte=settings.BOT_USER_PROFILE_MAX_FAILURES)
 
 
 class BotUser(models.Model):
@@ -26,18 +66,47 @@ class BotUser(models.Model):
 
     Model for storing users of our bot.
 
-    Note that the first_name, last_name, profile_pic, etc. of the user are retrieved lazily via
-    the Messenger Platform API.
+    Note that the first_name, last_name, profile_pic, etc. of the user are read from a profile
+    snapshot persisted on the model. The snapshot is taken from the Messenger Platform API when
+    the user is created and refreshed in the background by the refresh_user_profiles task.
     """
+    PROFILE_FIELDS = (
+        '_first_name',
+        '_last_name',
+        '_profile_pic',
+        '_gender',
+        '_locale',
+        '_timezone',
+        '_search_name',
+        '_search_last_name',
+        'profile_fetched_at',
+        'profile_failures',
+        'profile_retry_at',
+    )
+
     bot_id = models.CharField(max_length=30, primary_key=True)
 
-    # used for user search only
+    # Profile snapshot
     _first_name = models.CharField(max_length=35, blank=True)
     _last_name = models.CharField(max_length=35, blank=True)
+    _profile_pic = models.TextField(blank=True)
     _gender = models.CharField(max_length=20, blank=True)
+    _locale = models.CharField(max_length=10, blank=True)
+    _timezone = models.FloatField(null=True, blank=True)
+    profile_fetched_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # Normalized names, used for user search only (see bot/utils/search.py)
+    _search_name = models.CharField(max_length=71, blank=True, db_index=True)
+    _search_last_name = models.CharField(max_length=35, blank=True, db_index=True)
+
+    # Consecutive failed profile requests and when to try again
+    profile_failures = models.PositiveIntegerField(default=0)
+    profile_retry_at = models.DateTimeField(null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = BotUserQuerySet.as_manager()
+
     @property
     def full_name(self):
         if not self.first_name and not self.last_name:
@@ -45,52 +114,127 @@ class BotUser(models.Model):
         return ("%s %s" % (self.first_name, self.last_name)).strip()
 
     @property
-    @user_field
     def first_name(self):
-        return self.user_profile.first_name
+        return self._first_name
 
     @property
-    @user_field
     def last_name(self):
-        return self.user_profile.last_name
+        return self._last_name
 
     @property
-    @user_field
     def profile_pic(self):
-        return self.user_profile.profile_pic
+        return self._profile_pic
 
     @property
-    @user_field
     def gender(self):
-        return self.user_profile.gender
+        return self._gender
 
     @property
-    @user_field
     def locale(self):
-        return self.user_profile.locale
+        return self._locale
 
     @property
-    @user_field
     def timezone(self):
-        return self.user_profile.timezone
+        return self._timezone
 
     @property
     def sender(self):
         return Sender(id=self.bot_id)
 
+    @property
+    def is_unreachable(self):
+        return self.profile_failures >= settings.BOT_USER_PROFILE_MAX_FAILURES
+
+    @property
+    def profile_miss_key(self):
+        return 'bot_user_profile_miss:%s' % self.bot_id
+
     @property
     def user_profile(self):
+        """user_profile
+
+        Live profile from the Messenger Platform API, or None if it couldn't be retrieved.
+
+        Failed requests are negatively cached with an exponential backoff, so a profile that
+        just failed isn't requested again until the backoff expires. The backoff is also
+        persisted in profile_retry_at, for processes that don't share the cache.
+        """
         if not hasattr(self, '_user_profile'):
+            self._user_profile = None
+            if self.profile_retry_at is not None and self.profile_retry_at > timezone.now():
+                return None
+            if cache.get(self.profile_miss_key) is not None:
+                return None
+
             try:
                 self._user_profile = UserProfile(token, self.sender)
             except:
-                self._user_profile = lambda: None
+                logger.warning("Couldn't retrieve user profile for %s", self.bot_id, exc_info=True)
+                self.record_profile_failure()
         return self._user_profile
 
+    def record_profile_failure(self):
+        """record_profile_failure
+
+        Counts a failed profile request and backs off before the next one. The backoff doubles
+        with every consecutive failure, from BOT_USER_PROFILE_BACKOFF up to
+        BOT_USER_PROFILE_MAX_BACKOFF seconds.
+        """
+        self.profile_failures += 1
+        backoff = min(
+            settings.BOT_USER_PROFILE_BACKOFF * 2 ** (self.profile_failures - 1),
+            settings.BOT_USER_PROFILE_MAX_BACKOFF,
+        )
+        self.profile_retry_at = timezone.now() + timedelta(seconds=backoff)
+        cache.set(self.profile_miss_key, self.profile_failures, backoff)
+
+        # Persist for users that already exist, no-op otherwise
+        BotUser.objects.filter(bot_id=self.bot_id).update(
+            profile_failures=F('profile_failures') + 1,
+            profile_retry_at=self.profile_retry_at,
+        )
+
     def set_user_fields(self):
-        self._first_name = self.first_name
-        self._last_name = self.last_name
-        self._gender = self.gender
+        """set_user_fields
+
+        Copies the live user profile into the profile snapshot fields.
+
+        Returns
+        -------
+        success: bool
+            whether or not the profile could be retrieved
+        """
+        profile = self.user_profile
+        if profile is None:
+            return False
+
+        self._first_name = getattr(profile, 'first_name', '')[:35]
+        self._last_name = getattr(profile, 'last_name', '')[:35]
+        self._profile_pic = getattr(profile, 'profile_pic', '')
+        self._gender = getattr(profile, 'gender', '')[:20]
+        self._locale = getattr(profile, 'locale', '')[:10]
+        self._timezone = getattr(profile, 'timezone', None)
+        self._search_name = normalize(self.full_name)[:71]
+        self._search_last_name = normalize(self._last_name)[:35]
+        self.profile_fetched_at = timezone.now()
+        self.profile_failures = 0
+        self.profile_retry_at = None
+        return True
+
+    def refresh_profile(self):
+        """refresh_profile
+
+        Fetches the live user profile and saves it as the profile snapshot.
+        """
+        if hasattr(self, '_user_profile'):
+            del self._user_profile
+        cache.delete(self.profile_miss_key)
+        self.profile_retry_at = None
+
+        if self.set_user_fields():
+            self.save(update_fields=self.PROFILE_FIELDS)
+            return True
+        return False
 
     def serialize(self):
         data = {'id': self.bot_id}
@@ -114,27 +258,284 @@ class BotMessage(models.Model):
 
     Model for storing messages our bot receives.
     """
-    bot_id = models.CharField(max_length=30, db_index=True)
+    bot_id = models.CharField(max_length=30)
     timestamp = models.DateTimeField(db_index=True)
+
+    # Message id and sequence number from the webhook, if the event has them
+    mid = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    seq = models.IntegerField(null=True, blank=True)
+
     received = models.BooleanField(default=True)
     delivered_time = models.DateTimeField(null=True, blank=True)
     read_time = models.DateTimeField(null=True, blank=True)
 
-    # Generic payload column that will store messaging object as json string
-    payload = models.TextField(blank=True)
+    # Generic payload column that will store messaging object, compressed or as native json
+    # depending on BOT_MESSAGE_PAYLOAD_STORAGE
+    payload = PayloadField(default=dict, blank=True)
+
+    # Fields extracted from the payload, so common queries don't need to decode it
+    text_length = models.PositiveIntegerField(null=True, blank=True)
+    attachment_types = models.CharField(max_length=100, blank=True)
+    quick_reply_payload = models.CharField(max_length=1000, blank=True)
 
     # Order by most recent message
+    #
+    # The composite indexes serve per user history and watermark queries. On databases that
+    # support it, partial indexes for the watermark queries are also created after migrating
+    # (see bot/indexes.py).
     class Meta:
         ordering = ['-timestamp']
+        index_together = [
+            ('bot_id', 'timestamp'),
+            ('bot_id', 'received', 'timestamp'),
+        ]
 
     @property
     def sent(self):
         return not self.received
 
+    @property
+    def watermark(self):
+        """watermark
+
+        The BotWatermark of the user, or None if no receipts were logged for them or receipts are
+        kept on each message (BOT_MESSAGE_RECEIPTS is 'message').
+        """
+        if not hasattr(self, '_watermark'):
+            if settings.BOT_MESSAGE_RECEIPTS == 'watermark':
+                self._watermark = BotWatermark.objects.filter(bot_id=self.bot_id).first()
+            else:
+                self._watermark = None
+        return self._watermark
+
     @property
     def read(self):
-        return self.read_time is not None
+        if self.read_time is not None:
+            return True
+        return self.sent and self.watermark is not None and self.watermark.has_read(self.timestamp)
 
     @property
     def delivered(self):
-        return self.delivered_time is not None
+        if self.delivered_time is not None:
+            return True
+        return self.sent and self.watermark is not None and self.watermark.has_delivered(self.timestamp)
+
+    def set_payload(self, payload):
+        """set_payload
+
+        Sets the payload and the fields extracted from it.
+        """
+        self.payload = payload
+
+        message = payload.get('message') or {}
+        text = message.get('text')
+        attachments = message.get('attachments') or []
+        quick_reply = message.get('quick_reply') or {}
+
+        self.text_length = len(text) if text is not None else None
+        self.attachment_types = ','.join(sorted(set(a.get('type', '') for a in attachments)))[:100]
+        self.quick_reply_payload = quick_reply.get('payload', '')[:1000]
+
+    def serialize(self):
+        def isoformat(dt):
+            return dt.isoformat() if dt else None
+
+        return {
+            'id': self.id,
+            'bot_id': self.bot_id,
+            'timestamp': isoformat(self.timestamp),
+            'mid': self.mid,
+            'seq': self.seq,
+            'received': self.received,
+            'delivered_time': isoformat(self.delivered_time),
+            'read_time': isoformat(self.read_time),
+            'payload': self.payload,
+        }
+
+    @classmethod
+    def deserialize(cls, data):
+        """deserialize
+
+        Builds an unsaved BotMessage from the output of serialize().
+        """
+        def datetime_or_none(value):
+            return parse_datetime(value) if value else None
+
+        bm = cls(
+            id=data['id'],
+            bot_id=data['bot_id'],
+            timestamp=datetime_or_none(data['timestamp']),
+            mid=data['mid'],
+            seq=data['seq'],
+            received=data['received'],
+            delivered_time=datetime_or_none(data['delivered_time']),
+            read_time=datetime_or_none(data['read_time']),
+        )
+        bm.set_payload(data['payload'])
+        return bm
+
+    @classmethod
+    def archived(cls, start=None, end=None, bot_id=None):
+        """archived
+
+        Read-only access to the messages of sealed months, see MessageArchive.messages.
+        """
+        from .utils.archive import MessageArchive
+        return MessageArchive().messages(start=start, end=end, bot_id=bot_id)
+
+
+class BotWatermark(models.Model):
+    """BotWatermark
+
+    Model for storing the delivery and read watermarks of a user.
+
+    Used instead of setting delivered_time and read_time on every BotMessage when
+    BOT_MESSAGE_RECEIPTS is 'watermark'. A message we sent is delivered (or read) if its
+    timestamp is at or before the user's delivered (or read) watermark.
+    """
+    bot_id = models.CharField(max_length=30, primary_key=True)
+    delivered = models.DateTimeField(null=True, blank=True)
+    read = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def has_delivered(self, timestamp):
+        return self.delivered is not None and timestamp <= self.delivered
+
+    def has_read(self, timestamp):
+        return self.read is not None and timestamp <= self.read
+
+    @classmethod
+    def advance(cls, bot_id, delivered=None, read=None):
+        """advance
+
+        Moves the watermarks of a user forward, never backward, with a single UPDATE. The row is
+        created if the user has none yet.
+        """
+        fields = {'updated_at': timezone.now()}
+        for name, watermark in (('delivered', delivered), ('read', read)):
+            if watermark is not None:
+                fields[name] = Case(
+                    When(Q(**{name + '__isnull': True}) | Q(**{name + '__lt': watermark}), then=Value(watermark)),
+                    default=F(name),
+                )
+
+        if cls.objects.filter(bot_id=bot_id).update(**fields):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(bot_id=bot_id, delivered=delivered, read=read)
+        except IntegrityError:
+            # Created concurrently
+            cls.objects.filter(bot_id=bot_id).update(**fields)
+
+
+class BotConversationState(models.Model):
+    """BotConversationState
+
+    Model for persisting the conversation state of a user, see StateMachine in
+    bot/utils/state.py. The state lives in the cache and is written here behind it, so it
+    survives cache evictions and restarts.
+    """
+    bot_id = models.CharField(max_length=30, primary_key=True)
+    state = models.CharField(max_length=50)
+    data = PayloadField(default=dict, blank=True)
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def store(cls, bot_id, state, data, version, updated_at):
+        """store
+
+        Writes a conversation state unless a newer version of it is already stored. The row is
+        created if the user has none yet.
+        """
+        fields = {'state': state, 'data': data, 'version': version, 'updated_at': updated_at}
+        if cls.objects.filter(bot_id=bot_id, version__lt=version).update(**fields):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(bot_id=bot_id, **fields)
+        except IntegrityError:
+            # Already stored at this version or a newer one, or created concurrently
+            cls.objects.filter(bot_id=bot_id, version__lt=version).update(**fields)
+
+
+class ConversationRollup(models.Model):
+    """ConversationRollup
+
+    Model for storing aggregates of BotMessages per day or hour, see ConversationRollups in
+    bot/utils/analytics.py.
+    """
+    DAY = 'day'
+    HOUR = 'hour'
+    PERIOD_CHOICES = (
+        (DAY, 'Day'),
+        (HOUR, 'Hour'),
+    )
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateTimeField()
+
+    active_users = models.PositiveIntegerField(default=0)
+    messages_in = models.PositiveIntegerField(default=0)
+    messages_out = models.PositiveIntegerField(default=0)
+    delivered = models.PositiveIntegerField(default=0)
+    read = models.PositiveIntegerField(default=0)
+
+    # Replies to a user's messages and their total latency, in seconds
+    replies = models.PositiveIntegerField(default=0)
+    reply_latency = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ['start']
+        unique_together = [('period', 'start')]
+
+    @property
+    def delivery_rate(self):
+        return float(self.delivered) / self.messages_out if self.messages_out else None
+
+    @property
+    def read_rate(self):
+        return float(self.read) / self.messages_out if self.messages_out else None
+
+    @property
+    def average_reply_latency(self):
+        return self.reply_latency / self.replies if self.replies else None
+
+    def serialize(self):
+        return {
+            'period': self.period,
+            'start': self.start.isoformat(),
+            'active_users': self.active_users,
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'delivery_rate': self.delivery_rate,
+            'read_rate': self.read_rate,
+            'average_reply_latency': self.average_reply_latency,
+        }
+
+
+class ConversationRollupUser(models.Model):
+    """ConversationRollupUser
+
+    Model for storing the users already counted as active in a rollup period. Only kept while
+    the period can still get new messages.
+    """
+    period = models.CharField(max_length=4, choices=ConversationRollup.PERIOD_CHOICES)
+    start = models.DateTimeField(db_index=True)
+    bot_id = models.CharField(max_length=30)
+
+    class Meta:
+        unique_together = [('period', 'start', 'bot_id')]
+
+
+class ConversationRollupState(models.Model):
+    """ConversationRollupState
+
+    Model for storing the high-water mark of the rollups: the id of the last BotMessage rolled up.
+    """
+    name = models.CharField(max_length=30, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,141 @@
+from contextlib import contextmanager
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import (
+    DatabaseError,
+    DEFAULT_DB_ALIAS,
+    connections,
+)
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+@contextmanager
+def read_your_writes():
+    """read_your_writes
+
+    Within the block, once the current thread has written to the primary, its reads go to the
+    primary as well so they see their own writes. Wrap units of work such as a webhook batch
+    with it.
+    """
+    depth = getattr(_state, 'depth', 0)
+    _state.depth = depth + 1
+    try:
+        yield
+    finally:
+        _state.depth = depth
+        if not depth:
+            _state.wrote = False
+
+
+@contextmanager
+def use_primary():
+    """use_primary
+
+    Within the block, all reads of the current thread go to the primary.
+    """
+    pinned = getattr(_state, 'pinned', 0)
+    _state.pinned = pinned + 1
+    try:
+        yield
+    finally:
+        _state.pinned = pinned
+
+
+def reads_primary():
+    """reads_primary
+
+    Whether reads of the current thread go to the primary, inside use_primary() or after a
+    write inside read_your_writes(). Threads started within such a block should use_primary().
+    """
+    return bool(getattr(_state, 'pinned', 0) or (getattr(_state, 'depth', 0) and getattr(_state, 'wrote', False)))
+
+
+class ReplicaHealth(object):
+    """ReplicaHealth
+
+    Keeps track of which replicas can serve reads. A replica is healthy if it can be queried and,
+    on Postgres, lags less than DATABASE_REPLICA_MAX_LAG seconds behind the primary. Checks
+    are cached for DATABASE_REPLICA_CHECK_INTERVAL seconds.
+    """
+    # The time since the last replayed transaction only measures lag while there is WAL left to
+    # replay, an idle primary sends none. Functions were renamed from xlog to wal in Postgres 10.
+    LAG_SQL = (
+        "SELECT CASE WHEN %(receive)s() = %(replay)s() THEN 0 "
+        "ELSE COALESCE(EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp())), 0) END"
+    )
+    LAG_FUNCTIONS = {
+        'wal': {'receive': 'pg_last_wal_receive_lsn', 'replay': 'pg_last_wal_replay_lsn'},
+        'xlog': {'receive': 'pg_last_xlog_receive_location', 'replay': 'pg_last_xlog_replay_location'},
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.healthy = []
+        self.checked_at = None
+
+    def replicas(self):
+        with self.lock:
+            now = time.time()
+            if self.checked_at is None or now - self.checked_at >= settings.DATABASE_REPLICA_CHECK_INTERVAL:
+                self.healthy = [alias for alias in settings.DATABASE_REPLICAS if self.check(alias)]
+                self.checked_at = now
+            return self.healthy
+
+    def check(self, alias):
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                if connection.vendor != 'postgresql':
+                    cursor.execute("SELECT 1")
+                    return True
+
+                functions = self.LAG_FUNCTIONS['wal' if connection.pg_version >= 100000 else 'xlog']
+                cursor.execute(self.LAG_SQL % functions)
+                lag = float(cursor.fetchone()[0])
+        except DatabaseError:
+            logger.warning("Replica %s is unavailable, reading from the primary", alias, exc_info=True)
+            return False
+
+        if lag > settings.DATABASE_REPLICA_MAX_LAG:
+            logger.warning("Replica %s lags %.1fs behind, reading from the primary", alias, lag)
+            return False
+        return True
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter(object):
+    """ReplicaRouter
+
+    Database router that sends writes to the primary and reads to a random healthy replica of
+    DATABASE_REPLICAS. Reads fall back to the primary when there is no healthy replica, inside
+    use_primary() and after a write inside read_your_writes().
+    """
+    def db_for_read(self, model, **hints):
+        if reads_primary():
+            return DEFAULT_DB_ALIAS
+
+        replicas = replica_health.replicas() if settings.DATABASE_REPLICAS else []
+        if not replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if getattr(_state, 'depth', 0):
+            _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -1,45 +1,154 @@
-import json
+from datetime import datetime
+import os
 from celery import task
 from celery.decorators import periodic_task
 from celery.schedules import crontab
+from django.conf import settings
+from django.db import transaction
 
-from messenger import Webhook
-from .utils.log import MessageLogger
+from .models import BotUser
+from .routers import (
+    read_your_writes,
+    use_primary,
+)
+from .utils.analytics import ConversationRollups
+from .utils.archive import (
+    MessageArchive,
+    NDJSONArchiver,
+)
+from .utils.log import BufferedMessageLogger
+from .utils.retention import (
+    MessageCleaner,
+    RetentionPolicy,
+)
+from .utils.state import StateMachine
+from .utils.trace import task_span
 
 
-@task(name="log_payload")
-def log_payload(data):
+@task(name="handle_payload", bind=True)
+def handle_payload(self, data):
+    """handle_payload
+
+    Asynchronous task to handle message event payload, see handle_payload in utils/handle.py.
+    """
+    # Imported here, the handlers import this module
+    from .utils.handle import handle_payload as handle
+
+    with task_span('handle_payload', self.request), read_your_writes():
+        handle(data)
+
+
+@task(name="log_payload", bind=True)
+def log_payload(self, data):
     """log_payload
 
-    Asynchronous task to log the message event payload.
+    Asynchronous task to log the message event payload. Messages of the payload are written
+    in bulk when the task ends.
+    """
+    with task_span('log_payload', self.request), read_your_writes(), BufferedMessageLogger() as mlogger:
+        mlogger.log_payload(data)
+
+
+@task(name="enrich_bot_user")
+def enrich_bot_user(bot_id):
+    """enrich_bot_user
+
+    Asynchronous task to fetch the profile snapshot of a newly created user.
     """
-    payload = json.loads(data)
-    wh = Webhook(payload)
+    # The user was just created, replicas might not have it yet
+    try:
+        with use_primary():
+            bot_user = BotUser.objects.get(bot_id=bot_id)
+    except BotUser.DoesNotExist:
+        return
 
-    mlogger = MessageLogger()
-    for entry in wh.entries:
-        for event in entry.messaging:
-            mlogger.log(event)
+    bot_user.refresh_profile()
+
+
+@task(name="persist_conversation_state")
+def persist_conversation_state(bot_id):
+    """persist_conversation_state
+
+    Asynchronous task to write the cached conversation state of a user to the database, see
+    StateMachine in utils/state.py.
+    """
+    StateMachine.persist(bot_id)
+
+
+@periodic_task(name="refresh_user_profiles", run_every=(crontab(minute=0)))
+def refresh_user_profiles():
+    """refresh_user_profiles
+
+    Refreshes stale user profile snapshots in batches. This runs at the top of every hour.
+
+    Each batch of snapshots is fetched from the Messenger Platform API and then written in a
+    single transaction.
+    """
+    batch_size = settings.BOT_USER_PROFILE_BATCH_SIZE
+    bot_ids = list(
+        BotUser.objects.stale_profiles()
+        .order_by('profile_fetched_at')
+        .values_list('bot_id', flat=True)[:settings.BOT_USER_PROFILE_REFRESH_LIMIT]
+    )
+
+    for i in range(0, len(bot_ids), batch_size):
+        bot_users = BotUser.objects.filter(bot_id__in=bot_ids[i:i + batch_size])
+        refreshed = [bu for bu in bot_users if bu.set_user_fields()]
+
+        with transaction.atomic():
+            for bu in refreshed:
+                bu.save(update_fields=BotUser.PROFILE_FIELDS)
+
+
+@periodic_task(name="rollup_messages", run_every=(crontab(minute='*/15')))
+def rollup_messages():
+    """rollup_messages
+
+    Rolls up messages logged since the last run into the conversation analytics. This runs every
+    15 minutes.
+    """
+    ConversationRollups().update()
+
+
+@periodic_task(name="seal_message_partitions", run_every=(crontab(hour=6, minute=30, day_of_month=1)))
+def seal_message_partitions():
+    """seal_message_partitions
+
+    Moves messages of months past BOT_MESSAGE_HOT_MONTHS into archive segments. This runs at
+    6:30am (UTC) on the first of every month, if BOT_MESSAGE_ARCHIVE_DIR is set.
+    """
+    if settings.BOT_MESSAGE_ARCHIVE_DIR:
+        MessageArchive().seal()
+
+
+@periodic_task(name="expire_conversation_states", run_every=(crontab(hour=7, minute=0)))
+def expire_conversation_states():
+    """expire_conversation_states
+
+    Deletes stored conversation states untouched for BOT_CONVERSATION_STATE_TTL seconds. This
+    runs at 7am (UTC) every day.
+    """
+    StateMachine.expire()
 
 
 # Use the following as a model for creating periodically running tasks.
 #
 # See http://docs.celeryproject.org/en/latest/userguide/periodic-tasks.html#crontab-schedules
 # Be sure to make the scheduled time in UTC.
-#
-# Feel free to remove or comment this out so this task doesn't get caught in the queue.
-@periodic_task(name="cleanup_messages", run_every=(crontab(hour=7, minute=30, day_of_week=1)))
+@periodic_task(name="cleanup_messages", run_every=(crontab(hour=7, minute=30)))
 def cleanup_messages():
     """cleanup_messages
 
-    Cleans up old messages based on given threshold. This runs at 7:30am (UTC) every Monday.
-    """
-    # THRESHOLD = 5000
+    Cleans up old messages based on the retention policies in BOT_MESSAGE_RETENTION. This runs
+    at 7:30am (UTC) every day.
 
-    # bm_count = BotMessage.objects.count()
-    # if bm_count > THRESHOLD:
-    #     num_delete = bm_count - THRESHOLD
+    If BOT_MESSAGE_ARCHIVE_DIR is set, deleted messages are archived there first.
+    """
+    archiver = None
+    if settings.BOT_MESSAGE_ARCHIVE_DIR:
+        filename = 'cleanup-%s.ndjson.gz' % datetime.utcnow().strftime('%Y-%m-%d')
+        archiver = NDJSONArchiver(os.path.join(settings.BOT_MESSAGE_ARCHIVE_DIR, filename))
 
-    #     bms = BotMessage.objects.order_by('timestamp')
-    #     bms[:num_delete].delete()
-    pass
+    cleaner = MessageCleaner(archiver=archiver)
+    for config in settings.BOT_MESSAGE_RETENTION:
+        cleaner.clean(RetentionPolicy.from_config(config))
@@ -1,3 +1,1143 @@
-from django.test import TestCase
+from __future__ import unicode_literals
 
-# Create your tests here.
+import calendar
+import csv
+from datetime import (
+    datetime,
+    timedelta,
+)
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from celery import current_app
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import (
+    OperationalError,
+    connection,
+    transaction,
+)
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils import (
+    six,
+    timezone,
+)
+from django.utils.six import StringIO
+from messenger import Sender
+
+from . import (
+    models,
+    routers,
+    tasks,
+    views,
+)
+from .fields import CompressedJSONField
+from .indexes import (
+    PARTIAL_INDEXES,
+    create_indexes,
+)
+from .management.commands import export
+from .models import (
+    BotConversationState,
+    BotMessage,
+    BotUser,
+    BotWatermark,
+    ConversationRollup,
+)
+from .utils import (
+    consume,
+    state,
+    trace,
+)
+from .utils.analytics import ConversationRollups
+from .utils.archive import MessageArchive
+from .utils.autoscale import ConcurrencyController
+from .utils.base import handle as base_handle
+from .utils.cache import LRUCache
+from .utils.capture import (
+    SegmentWriter,
+    iter_segments,
+    segment_paths,
+)
+from .utils.history import ConversationHistory
+from .utils.intents import IntentMatcher
+from .utils.log import (
+    BufferedMessageLogger,
+    MessageLogger,
+)
+from .utils.pool import GroupPool
+from .utils.retention import (
+    MessageCleaner,
+    RetentionPolicy,
+)
+from .utils.routing import PostbackRouter
+from .utils.search import search_bot_users
+
+
+def message_event(sender, mid, text='hello', timestamp=None):
+    return {
+        'sender': {'id': sender},
+        'recipient': {'id': 'page'},
+        'timestamp': timestamp or int(time.time() * 1000),
+        'message': {'mid': mid, 'seq': 1, 'text': text},
+    }
+
+
+def receipt_event(sender, kind, watermark):
+    return {
+        'sender': {'id': sender},
+        'recipient': {'id': 'page'},
+        'timestamp': int(time.time() * 1000),
+        kind: {'watermark': int(calendar.timegm(watermark.utctimetuple()) * 1000), 'seq': 0},
+    }
+
+
+def webhook_payload(*events):
+    return json.dumps({
+        'object': 'page',
+        'entry': [{'id': 'page', 'time': int(time.time() * 1000), 'messaging': list(events)}],
+    })
+
+
+class FakeMessage(object):
+    """FakeMessage
+
+    Broker message recording how it was settled.
+    """
+    def __init__(self):
+        self.headers = {'task': 'log_payload'}
+        self.settled = None
+
+    def ack(self):
+        self.settled = 'ack'
+
+    def reject(self):
+        self.settled = 'reject'
+
+    def requeue(self):
+        self.settled = 'requeue'
+
+
+class FakeController(ConcurrencyController):
+    """FakeController
+
+    ConcurrencyController over fake workers, with the maintenance worker on another queue.
+    """
+    def __init__(self, pool_sizes, **kwargs):
+        super(FakeController, self).__init__(None, 'replies', cooldown=0, **kwargs)
+        self.pool_sizes = dict(pool_sizes)
+        self.pool_sizes['maintenance@host'] = 1
+        self.depth = 0
+        self.processed = 0
+
+    def sample_depth(self):
+        return self.depth
+
+    def sample_destinations(self):
+        return sorted(node for node in self.pool_sizes if node.startswith('replies'))
+
+    def sample_workers(self, destinations):
+        return self.processed, dict((node, self.pool_sizes[node]) for node in destinations)
+
+    def resize(self, node, delta):
+        self.pool_sizes[node] += delta
+
+
+class ConcurrencyControllerTests(SimpleTestCase):
+    def setUp(self):
+        self.workers = dict(('replies@host%d' % i, 2) for i in range(3))
+
+    def test_grows_each_worker_within_max_size(self):
+        # Nothing processed with a backlog is an unbounded latency
+        controller = FakeController(self.workers, max_size=3)
+        controller.depth = 1000
+        for _ in range(5):
+            controller.tick()
+
+        self.assertEqual(controller.pool_sizes, {
+            'replies@host0': 3,
+            'replies@host1': 3,
+            'replies@host2': 3,
+            'maintenance@host': 1,
+        })
+
+    def test_shrinks_each_worker_within_min_size(self):
+        controller = FakeController(self.workers, min_size=1)
+        for _ in range(5):
+            controller.tick()
+
+        self.assertEqual(controller.pool_sizes, {
+            'replies@host0': 1,
+            'replies@host1': 1,
+            'replies@host2': 1,
+            'maintenance@host': 1,
+        })
+
+    def test_first_sample_makes_no_change(self):
+        controller = FakeController(self.workers)
+        controller.depth = 1000
+        self.assertEqual(controller.tick(), {'replies@host0': 0, 'replies@host1': 0, 'replies@host2': 0})
+
+
+class IntentMatcherTests(SimpleTestCase):
+    def test_earlier_lower_priority_regex_doesnt_hide_higher_priority(self):
+        matcher = IntentMatcher()
+        matcher.regex('low', r'where is', priority=0)
+        matcher.regex('high', r'is my order \d+', priority=10)
+        self.assertEqual(matcher.match('where is my order 42').intent, 'high')
+
+    def test_keyword_beats_lower_priority_regex(self):
+        matcher = IntentMatcher()
+        matcher.regex('order', r'order \d+', priority=0)
+        matcher.keyword('greeting', ['hello'], priority=1)
+        self.assertEqual(matcher.match('Order 42, H\u00c9LLO').intent, 'greeting')
+
+    def test_keywords_match_whole_words(self):
+        matcher = IntentMatcher()
+        matcher.keyword('greeting', ['hi'])
+        self.assertIsNone(matcher.match('this'))
+
+    def test_native_str_rules_and_text(self):
+        # Byte strings on Python 2
+        matcher = IntentMatcher()
+        matcher.keyword('greeting', [str('hi'), str('hello')])
+        matcher.regex('order', str(r'order \d+'), priority=1)
+        self.assertEqual(matcher.match(str('Hi there')).intent, 'greeting')
+        self.assertEqual(matcher.match(str('hi, order 42')).intent, 'order')
+
+
+class CompressedJSONFieldTests(SimpleTestCase):
+    def setUp(self):
+        self.field = CompressedJSONField()
+
+    def load(self, value):
+        return self.field.from_db_value(value, None, None, None)
+
+    def test_round_trip(self):
+        value = {'message': {'text': 'caf\u00e9 "quoted"', 'seq': 1}}
+        stored = self.field.get_prep_value(value)
+        self.assertTrue(stored.startswith(CompressedJSONField.PREFIX))
+        self.assertEqual(self.load(stored), value)
+
+    def test_loads_plain_json_of_the_former_text_column(self):
+        self.assertEqual(self.load('{"message": {"text": "caf\\u00e9"}}'), {'message': {'text': 'caf\u00e9'}})
+        self.assertEqual(self.load(''), {})
+        self.assertIsNone(self.load(None))
+
+
+class ReceiptTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.messages = [
+            BotMessage.objects.create(bot_id='user', timestamp=self.now - timedelta(minutes=i), received=False)
+            for i in range(5)
+        ]
+        BotWatermark.objects.create(bot_id='user', delivered=self.now, read=self.now - timedelta(minutes=2))
+
+    @override_settings(BOT_MESSAGE_RECEIPTS='message')
+    def test_message_receipts_dont_query_watermarks(self):
+        messages = list(BotMessage.objects.filter(bot_id='user'))
+        with self.assertNumQueries(0):
+            self.assertEqual([bm.delivered for bm in messages], [False] * 5)
+            self.assertEqual([bm.read for bm in messages], [False] * 5)
+
+    @override_settings(BOT_MESSAGE_RECEIPTS='watermark')
+    def test_watermark_receipts(self):
+        messages = list(BotMessage.objects.filter(bot_id='user').order_by('-timestamp'))
+        self.assertEqual([bm.delivered for bm in messages], [True] * 5)
+        self.assertEqual([bm.read for bm in messages], [False, False, True, True, True])
+
+
+class WatermarkTests(TestCase):
+    def test_advance_never_moves_back(self):
+        now = timezone.now()
+        BotWatermark.advance('user', delivered=now)
+        BotWatermark.advance('user', delivered=now - timedelta(minutes=1), read=now - timedelta(minutes=2))
+        BotWatermark.advance('user', read=now - timedelta(minutes=3))
+
+        watermark = BotWatermark.objects.get(bot_id='user')
+        self.assertEqual((watermark.delivered, watermark.read), (now, now - timedelta(minutes=2)))
+
+    @override_settings(BOT_MESSAGE_RECEIPTS='watermark')
+    def test_buffered_receipts_are_coalesced(self):
+        start = datetime(2016, 5, 1, 12, tzinfo=timezone.utc)
+        events = [receipt_event('user', 'delivery', start + timedelta(minutes=i)) for i in (1, 3, 2)]
+        events.append(receipt_event('user', 'read', start))
+
+        with BufferedMessageLogger() as mlogger:
+            mlogger.log_payload(webhook_payload(*events))
+            self.assertEqual(BotWatermark.objects.count(), 0)
+
+        watermark = BotWatermark.objects.get(bot_id='user')
+        self.assertEqual((watermark.delivered, watermark.read), (start + timedelta(minutes=3), start))
+
+
+class LogBatchConsumerTests(TestCase):
+    def consume(self, bodies):
+        consumer = consume.LogBatchConsumer(None)
+        messages = [FakeMessage() for _ in bodies]
+        consumer.batch = list(zip(bodies, messages))
+        consumer.process()
+        return [m.settled for m in messages]
+
+    def test_logs_a_batch(self):
+        bodies = [[(webhook_payload(message_event('user', 'mid-%d' % i)),), {}, {}] for i in range(3)]
+        self.assertEqual(self.consume(bodies), ['ack'] * 3)
+        self.assertEqual(BotMessage.objects.filter(bot_id='user').count(), 3)
+
+    def test_rejects_bad_payloads_only(self):
+        bodies = [
+            [(webhook_payload(message_event('user', 'mid-1')),), {}, {}],
+            [('not json',), {}, {}],
+            [(), {}, {}],
+        ]
+        self.assertEqual(self.consume(bodies), ['ack', 'reject', 'reject'])
+        self.assertEqual(BotMessage.objects.filter(mid='mid-1').count(), 1)
+
+    def test_requeues_on_database_outage(self):
+        def log_batch(payloads):
+            raise OperationalError('server closed the connection unexpectedly')
+
+        original, consume.log_batch = consume.log_batch, log_batch
+        try:
+            bodies = [[(webhook_payload(message_event('user', 'mid-1')),), {}, {}]]
+            self.assertEqual(self.consume(bodies), ['requeue'])
+        finally:
+            consume.log_batch = original
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        for bot_id, name, last_name in [
+            ('1', 'ana garcia', 'garcia'),
+            ('2', 'anabel lopez', 'lopez'),
+            ('3', 'luis anaya', 'anaya'),
+            ('4', 'ana', ''),
+        ]:
+            BotUser.objects.create(bot_id=bot_id, _search_name=name, _search_last_name=last_name)
+
+    def search(self, query, **kwargs):
+        return [bot_user.bot_id for bot_user in search_bot_users(query, **kwargs)]
+
+    def test_ranks_exact_then_full_name_then_last_name(self):
+        self.assertEqual(self.search('\u00c1na'), ['4', '1', '2', '3'])
+
+    def test_pages(self):
+        self.assertEqual(self.search('ana', page=2, page_size=3), ['3'])
+
+    def test_native_str_query(self):
+        # Byte string on Python 2
+        self.assertEqual(self.search(str('Anaya')), ['3'])
+
+
+class UserProfileBackoffTests(TestCase):
+    def setUp(self):
+        self.requests = []
+        self.original = models.UserProfile
+        models.UserProfile = self.fetch
+
+    def tearDown(self):
+        models.UserProfile = self.original
+        cache.clear()
+
+    def fetch(self, token, sender):
+        self.requests.append(sender.id)
+        raise ValueError("(#100) No profile available for that user")
+
+    def test_backs_off_after_failure(self):
+        bot_user = BotUser.objects.create(bot_id='user')
+        self.assertIsNone(bot_user.user_profile)
+        self.assertIsNone(BotUser.objects.get(bot_id='user').user_profile)
+        self.assertEqual(self.requests, ['user'])
+
+        bot_user = BotUser.objects.get(bot_id='user')
+        self.assertEqual(bot_user.profile_failures, 1)
+        self.assertGreater(bot_user.profile_retry_at, timezone.now())
+
+    def test_persisted_backoff_applies_without_cache(self):
+        # As in another process with its own cache
+        BotUser.objects.create(bot_id='user', profile_failures=1,
+                               profile_retry_at=timezone.now() + timedelta(minutes=5))
+        self.assertIsNone(BotUser.objects.get(bot_id='user').user_profile)
+        self.assertEqual(self.requests, [])
+
+    def test_fetches_again_after_backoff(self):
+        BotUser.objects.create(bot_id='user', profile_failures=1,
+                               profile_retry_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(BotUser.objects.get(bot_id='user').user_profile)
+        self.assertEqual(self.requests, ['user'])
+        self.assertEqual(BotUser.objects.get(bot_id='user').profile_failures, 2)
+
+
+class GroupPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = GroupPool(threads=3)
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def handle(self, key, items):
+        for item in items:
+            with self.lock:
+                self.handled.append((key, item))
+
+    def test_keeps_order_within_groups(self):
+        groups = [('user-%d' % i, list(range(20))) for i in range(5)]
+        self.assertEqual(self.pool.run(self.handle, groups, deadline=5), [])
+        for key, items in groups:
+            self.assertEqual([item for k, item in self.handled if k == key], items)
+
+    def test_returns_unfinished_groups_at_deadline(self):
+        release = threading.Event()
+
+        def handle(key, items):
+            if key == 'hung':
+                release.wait(5)
+            self.handle(key, items)
+
+        try:
+            unfinished = self.pool.run(handle, [('hung', [1]), ('user', [1])], deadline=0.2)
+        finally:
+            release.set()
+        self.assertEqual(unfinished, ['hung'])
+        self.assertIn(('user', 1), self.handled)
+
+
+class LateArchive(MessageArchive):
+    """LateArchive
+
+    MessageArchive where a message with a lower id is committed once the month is exported.
+    """
+    def read_segment(self, path):
+        if not BotMessage.objects.filter(id=15).exists():
+            BotMessage.objects.create(id=15, bot_id='user', timestamp=datetime(2015, 3, 20, tzinfo=timezone.utc))
+        return super(LateArchive, self).read_segment(path)
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def create(self, id, *timestamp):
+        return BotMessage.objects.create(
+            id=id, bot_id='user', timestamp=datetime(*timestamp, tzinfo=timezone.utc),
+            payload={'message': {'text': 'caf\u00e9 %d' % id}},
+        )
+
+    def test_seals_months_before_boundary(self):
+        self.create(10, 2015, 3, 2)
+        self.create(20, 2015, 4, 1)
+        hot = BotMessage.objects.create(bot_id='user', timestamp=timezone.now())
+
+        archive = MessageArchive(self.directory)
+        self.assertEqual(archive.seal(), 2)
+        self.assertEqual(len(archive.segments()), 2)
+        self.assertEqual(list(BotMessage.objects.values_list('id', flat=True)), [hot.id])
+
+        archived = list(archive.messages())
+        self.assertEqual([bm.id for bm in archived], [10, 20])
+        self.assertEqual(archived[0].payload, {'message': {'text': 'caf\u00e9 10'}})
+
+    def test_purges_exported_messages_only(self):
+        self.create(10, 2015, 3, 2)
+        self.create(20, 2015, 3, 10)
+
+        archive = LateArchive(self.directory)
+        self.assertEqual(archive.seal_month(datetime(2015, 3, 1, tzinfo=timezone.utc)), 2)
+        self.assertEqual([bm.id for bm in archive.messages()], [10, 20])
+        self.assertEqual(list(BotMessage.objects.values_list('id', flat=True)), [15])
+
+    def test_iterates_archive_and_table_oldest_first(self):
+        self.create(20, 2015, 4, 1)
+        self.create(30, 2015, 4, 5)
+        MessageArchive(self.directory).seal_month(datetime(2015, 4, 1, tzinfo=timezone.utc))
+        # Interrupted sealing, still in the table
+        self.create(20, 2015, 4, 1)
+        # Not sealed yet, older than the archived month
+        self.create(10, 2015, 3, 2)
+        hot = BotMessage.objects.create(bot_id='user', timestamp=timezone.now())
+        self.create(25, 2015, 4, 2)
+
+        with override_settings(BOT_MESSAGE_ARCHIVE_DIR=self.directory):
+            ids = [bm.id for bm in MessageLogger().iter_bot_messages(bot_id='user')]
+        self.assertEqual(ids, [10, 20, 25, 30, hot.id])
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEqual(len(cache), 2)
+
+    def test_expires_after_ttl(self):
+        cache = LRUCache(2, ttl=0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a', 'expired'), 'expired')
+
+
+class IdentityCacheTests(TestCase):
+    def tearDown(self):
+        base_handle.bot_user_cache.clear()
+
+    def test_gets_known_users_without_queries(self):
+        BotUser.objects.create(bot_id='user')
+        handler = base_handle.BaseMessageHandler()
+        bot_user = handler.get_bot_user(Sender(id='user'))
+        with self.assertNumQueries(0):
+            self.assertIs(handler.get_bot_user(Sender(id='user')), bot_user)
+            self.assertIs(base_handle.BaseMessageHandler().get_or_create_bot_user(Sender(id='user')), bot_user)
+
+    def test_unknown_users_arent_cached(self):
+        handler = base_handle.BaseMessageHandler()
+        self.assertIsNone(handler.get_bot_user(Sender(id='user')))
+        BotUser.objects.create(bot_id='user')
+        self.assertEqual(handler.get_bot_user(Sender(id='user')).bot_id, 'user')
+
+
+class FakeTask(object):
+    """FakeTask
+
+    Task recording whether the user it was sent for was committed.
+    """
+    def __init__(self):
+        self.sent = []
+
+    def apply_async(self, args):
+        self.sent.append((args[0], BotUser.objects.filter(bot_id=args[0]).exists()))
+
+
+class CreateBotUserTests(TransactionTestCase):
+    def setUp(self):
+        self.task = FakeTask()
+        self.original = base_handle.enrich_bot_user
+        base_handle.enrich_bot_user = self.task
+
+    def tearDown(self):
+        base_handle.enrich_bot_user = self.original
+        base_handle.bot_user_cache.clear()
+
+    def test_enriches_once_committed(self):
+        handler = base_handle.BaseMessageHandler()
+        with transaction.atomic():
+            handler.create_bot_user(Sender(id='user'))
+            self.assertEqual(self.task.sent, [])
+        self.assertEqual(self.task.sent, [('user', True)])
+
+    def test_existing_user_isnt_enriched_again(self):
+        BotUser.objects.create(bot_id='user')
+        base_handle.BaseMessageHandler().create_bot_user(Sender(id='user'))
+        self.assertEqual(self.task.sent, [])
+
+
+class CaptureTests(SimpleTestCase):
+    def setUp(self):
+        self.directories = [tempfile.mkdtemp() for _ in range(2)]
+        for directory in self.directories:
+            self.addCleanup(shutil.rmtree, directory)
+
+    def test_merges_segments_of_concurrent_processes(self):
+        # One writer per process, each with its own segments
+        for directory, times in zip(self.directories, [(1.0, 3.0), (2.0, 4.0)]):
+            writer = SegmentWriter(directory)
+            for received_at in times:
+                writer.write(b'{"t": %d}' % received_at, 'sha1=%d' % received_at, received_at)
+            writer.close()
+
+        records = list(iter_segments(segment_paths(self.directories)))
+        self.assertEqual([r[0] for r in records], [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(records[1][1:], (b'sha1=2', b'{"t": 2}'))
+
+
+class FakeProfile(object):
+    def __init__(self, token, sender):
+        self.first_name = 'Zo\u00eb'
+        self.last_name = 'Sald\u00e1\u00f1a'
+        self.profile_pic = 'https://example.com/%s.jpg' % sender.id
+        self.gender = 'female'
+        self.locale = 'es_ES'
+        self.timezone = 1
+
+
+class ProfileSnapshotTests(TestCase):
+    def setUp(self):
+        self.original = models.UserProfile
+        models.UserProfile = FakeProfile
+
+    def tearDown(self):
+        models.UserProfile = self.original
+        cache.clear()
+
+    def test_refreshes_stale_profiles(self):
+        now = timezone.now()
+        BotUser.objects.create(bot_id='new')
+        BotUser.objects.create(bot_id='stale', _first_name='Old', profile_fetched_at=now - timedelta(days=30))
+        BotUser.objects.create(bot_id='fresh', _first_name='Fresh', profile_fetched_at=now)
+        BotUser.objects.create(bot_id='failing', profile_failures=1, profile_retry_at=now + timedelta(hours=1))
+
+        tasks.refresh_user_profiles()
+
+        names = dict(BotUser.objects.values_list('bot_id', '_first_name'))
+        self.assertEqual(names, {'new': 'Zo\u00eb', 'stale': 'Zo\u00eb', 'fresh': 'Fresh', 'failing': ''})
+
+        bot_user = BotUser.objects.get(bot_id='new')
+        self.assertEqual(bot_user._search_name, 'zoe saldana')
+        self.assertGreaterEqual(bot_user.profile_fetched_at, now)
+
+    def test_serializes_the_snapshot_without_fetching(self):
+        models.UserProfile = None
+        bot_user = BotUser.objects.create(bot_id='user', _first_name='Ana', _last_name='Garc\u00eda', _locale='es_ES')
+        self.assertEqual(bot_user.serialize(), {'id': 'user', 'name': 'Ana Garc\u00eda', 'locale': 'es_ES'})
+
+
+@override_settings(BOT_MESSAGE_RECEIPTS='message')
+class MessageReceiptTests(TestCase):
+    def setUp(self):
+        self.start = datetime(2016, 5, 1, 12, tzinfo=timezone.utc)
+        for i in range(4):
+            BotMessage.objects.create(bot_id='user', timestamp=self.start + timedelta(minutes=i), received=False)
+        BotMessage.objects.create(bot_id='user', timestamp=self.start, received=True)
+        BotMessage.objects.create(bot_id='other', timestamp=self.start, received=False)
+
+    def log(self, kind, minutes):
+        event = receipt_event('user', kind, self.start + timedelta(minutes=minutes))
+        with self.assertNumQueries(1):
+            MessageLogger().log_payload(webhook_payload(event))
+
+    def times(self, field):
+        return list(BotMessage.objects.filter(bot_id='user', received=False).order_by('timestamp')
+                    .values_list(field, flat=True))
+
+    def test_updates_messages_up_to_the_watermarks(self):
+        self.log('delivery', 2)
+        self.log('read', 1)
+        delivered = self.start + timedelta(minutes=2)
+        read = self.start + timedelta(minutes=1)
+        self.assertEqual(self.times('delivered_time'), [delivered, delivered, delivered, None])
+        self.assertEqual(self.times('read_time'), [read, read, None, None])
+
+        # Receipts never move back
+        self.log('delivery', 1)
+        self.assertEqual(self.times('delivered_time'), [delivered, delivered, delivered, None])
+        self.assertFalse(BotMessage.objects.exclude(bot_id='user', received=False)
+                         .filter(delivered_time__isnull=False).exists())
+
+
+class BufferedMessageLoggerTests(TestCase):
+    def test_writes_once_full_or_on_exit(self):
+        with BufferedMessageLogger(max_size=2, max_age=60) as mlogger:
+            mlogger.log_payload(webhook_payload(message_event('user', 'mid-1')))
+            self.assertEqual(BotMessage.objects.count(), 0)
+            mlogger.log_payload(webhook_payload(message_event('user', 'mid-2'), message_event('user', 'mid-3')))
+            self.assertEqual(BotMessage.objects.count(), 2)
+        self.assertEqual(sorted(BotMessage.objects.values_list('mid', flat=True)), ['mid-1', 'mid-2', 'mid-3'])
+
+    def test_skips_logged_mids(self):
+        BotMessage.objects.create(bot_id='user', mid='mid-1', timestamp=timezone.now())
+        with BufferedMessageLogger() as mlogger:
+            mlogger.log_payload(webhook_payload(
+                message_event('user', 'mid-1'), message_event('user', 'mid-2'), message_event('user', 'mid-2'),
+            ))
+            self.assertEqual(mlogger.flush(), 1)
+        self.assertEqual(BotMessage.objects.filter(mid='mid-2').count(), 1)
+
+    @override_settings(BOT_MESSAGE_RECEIPTS='message')
+    def test_writes_messages_before_their_receipts(self):
+        echo = message_event('page', 'mid-1', timestamp=int(time.time() * 1000) - 1000)
+        echo['sender'], echo['recipient'] = {'id': 'page'}, {'id': 'user'}
+        echo['message']['is_echo'] = True
+        delivery = receipt_event('user', 'delivery', timezone.now())
+
+        with BufferedMessageLogger() as mlogger:
+            mlogger.log_payload(webhook_payload(echo, delivery))
+        self.assertIsNotNone(BotMessage.objects.get(mid='mid-1').delivered_time)
+
+
+class IndexTests(TestCase):
+    def index_names(self):
+        with connection.cursor() as cursor:
+            return set(connection.introspection.get_constraints(cursor, BotMessage._meta.db_table))
+
+    def test_partial_indexes_are_created_after_migrating(self):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            self.skipTest("No partial indexes on %s" % connection.vendor)
+        expected = set(name for _, name, _, _ in PARTIAL_INDEXES)
+        self.assertEqual(self.index_names() & expected, expected)
+
+        # Creating them again is a no-op
+        create_indexes(None, using=connection.alias)
+        self.assertEqual(self.index_names() & expected, expected)
+
+
+class MessageIdTests(TestCase):
+    def test_logging_a_payload_again_is_idempotent(self):
+        payload = webhook_payload(message_event('user', 'mid-1', text='hi'))
+        MessageLogger().log_payload(payload)
+        MessageLogger().log_payload(payload)
+
+        bm = MessageLogger().get_bot_message('mid-1')
+        self.assertEqual(BotMessage.objects.count(), 1)
+        self.assertEqual((bm.mid, bm.seq, bm.text_length), ('mid-1', 1, 2))
+
+    def test_messages_without_mid(self):
+        postback = {
+            'sender': {'id': 'user'},
+            'recipient': {'id': 'page'},
+            'timestamp': int(time.time() * 1000),
+            'postback': {'payload': 'GET_STARTED'},
+        }
+        MessageLogger().log_payload(webhook_payload(postback, postback))
+        self.assertEqual(list(BotMessage.objects.values_list('mid', flat=True)), [None, None])
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        # Two messages share each timestamp, so max_count has to break ties by id
+        for i in range(6):
+            BotMessage.objects.create(bot_id='user', timestamp=self.now - timedelta(days=i // 2))
+        BotMessage.objects.create(bot_id='other', timestamp=self.now - timedelta(days=10))
+        self.ids = list(BotMessage.objects.filter(bot_id='user').order_by('-timestamp', '-id')
+                        .values_list('id', flat=True))
+
+    def remaining(self, bot_id='user'):
+        return list(BotMessage.objects.filter(bot_id=bot_id).order_by('-timestamp', '-id')
+                    .values_list('id', flat=True))
+
+    def clean(self, policy, **kwargs):
+        return MessageCleaner(chunk_size=2, pause=0, **kwargs).clean(policy)
+
+    def test_max_count_keeps_most_recent(self):
+        self.assertEqual(self.clean(RetentionPolicy(max_count=3, bot_id='user')), 3)
+        self.assertEqual(self.remaining(), self.ids[:3])
+        self.assertEqual(len(self.remaining('other')), 1)
+
+    def test_max_age(self):
+        self.assertEqual(self.clean(RetentionPolicy.from_config({'max_age_days': 1.5})), 3)
+        self.assertEqual(self.remaining(), self.ids[:4])
+        self.assertEqual(self.remaining('other'), [])
+
+    def test_archives_deleted_chunks(self):
+        archived = []
+        progress = []
+
+        class Archiver(object):
+            def archive(self, bms):
+                archived.extend(bm.id for bm in bms)
+
+        self.clean(RetentionPolicy(max_count=1, bot_id='user'), archiver=Archiver(), progress=progress.append)
+        self.assertEqual(sorted(archived), sorted(self.ids[1:]))
+        self.assertEqual(progress, [2, 4, 5])
+
+
+class StaffUser(object):
+    is_active = True
+    is_staff = True
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # Pairs of messages share a timestamp, so pages have to break ties by id
+        for i in range(7):
+            BotMessage.objects.create(bot_id='user', timestamp=now - timedelta(minutes=i // 2))
+        BotMessage.objects.create(bot_id='other', timestamp=now)
+        self.ids = list(BotMessage.objects.filter(bot_id='user').order_by('-timestamp', '-id')
+                        .values_list('id', flat=True))
+        self.history = ConversationHistory('user', page_size=3)
+
+    def ids_of(self, page):
+        return [bm.id for bm in page.messages]
+
+    def test_pages_back_and_forth(self):
+        first = self.history.page()
+        self.assertEqual(self.ids_of(first), self.ids[:3])
+        self.assertIsNone(first.newer)
+
+        second = self.history.page(before=first.older)
+        self.assertEqual(self.ids_of(second), self.ids[3:6])
+
+        last = self.history.page(before=second.older)
+        self.assertEqual(self.ids_of(last), self.ids[6:])
+        self.assertIsNone(last.older)
+
+        self.assertEqual(self.ids_of(self.history.page(after=last.newer)), self.ids[3:6])
+        self.assertEqual(self.ids_of(self.history.page(after=second.newer)), self.ids[:3])
+        self.assertIsNone(self.history.page(after=second.newer).newer)
+
+    def test_iterates_whole_conversation(self):
+        self.assertEqual([bm.id for bm in self.history.iter_messages()], self.ids)
+
+    def get(self, user=None, **params):
+        request = RequestFactory().get('/history/user/', params)
+        request.user = user or StaffUser()
+        return views.history(request, 'user')
+
+    def test_view(self):
+        response = self.get(limit=2)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[:2])
+
+        response = self.get(before=data['older'], limit=2)
+        self.assertEqual([m['id'] for m in json.loads(response.content.decode('utf-8'))['messages']], self.ids[2:4])
+
+    def test_view_rejects_bad_parameters(self):
+        self.assertEqual(self.get(limit=0).status_code, 400)
+        self.assertEqual(self.get(before='not a cursor').status_code, 400)
+
+    def test_view_is_staff_only(self):
+        user = StaffUser()
+        user.is_staff = False
+        self.assertEqual(self.get(user=user).status_code, 302)
+
+
+class FakeReplicaHealth(object):
+    def replicas(self):
+        return ['replica0']
+
+
+@override_settings(DATABASE_REPLICAS=['replica0'])
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        self.original = routers.replica_health
+        routers.replica_health = FakeReplicaHealth()
+
+    def tearDown(self):
+        routers.replica_health = self.original
+
+    def test_reads_from_replicas_and_writes_to_primary(self):
+        self.assertEqual(self.router.db_for_read(BotMessage), 'replica0')
+        self.assertEqual(self.router.db_for_write(BotMessage), 'default')
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.router.db_for_read(BotMessage), 'default')
+
+    def test_use_primary(self):
+        with routers.use_primary():
+            with routers.use_primary():
+                self.assertEqual(self.router.db_for_read(BotMessage), 'default')
+            self.assertEqual(self.router.db_for_read(BotMessage), 'default')
+        self.assertEqual(self.router.db_for_read(BotMessage), 'replica0')
+
+    def test_read_your_writes(self):
+        with routers.read_your_writes():
+            self.assertEqual(self.router.db_for_read(BotMessage), 'replica0')
+            self.router.db_for_write(BotMessage)
+            with routers.read_your_writes():
+                self.assertEqual(self.router.db_for_read(BotMessage), 'default')
+            self.assertEqual(self.router.db_for_read(BotMessage), 'default')
+        self.assertEqual(self.router.db_for_read(BotMessage), 'replica0')
+
+        # Writes outside of a block don't pin reads
+        self.router.db_for_write(BotMessage)
+        self.assertEqual(self.router.db_for_read(BotMessage), 'replica0')
+
+
+@override_settings(BOT_MESSAGE_RECEIPTS='message')
+class ConversationRollupTests(TestCase):
+    def setUp(self):
+        # Settled, and recent enough that active users of the period are still kept
+        self.start = (timezone.now() - timedelta(hours=3)).replace(minute=0, second=0, microsecond=0)
+
+    def create(self, bot_id, seconds, received=True, **kwargs):
+        return BotMessage.objects.create(bot_id=bot_id, timestamp=self.start + timedelta(seconds=seconds),
+                                         received=received, **kwargs)
+
+    def rollup(self, period=ConversationRollup.HOUR):
+        rollup = ConversationRollup.objects.get(period=period, start__lte=self.start)
+        return dict((field, getattr(rollup, field)) for field in (
+            'active_users', 'messages_in', 'messages_out', 'delivered', 'read', 'replies', 'reply_latency',
+        ))
+
+    def test_rolls_up_incrementally(self):
+        self.create('user', 0)
+        self.create('user', 30, received=False, delivered_time=self.start, read_time=self.start)
+        self.create('other', 60)
+        # Not settled yet, later messages wait for it
+        unsettled = BotMessage.objects.create(bot_id='user', timestamp=timezone.now())
+        self.create('other', 90)
+
+        self.assertEqual(ConversationRollups().update(), 3)
+        unsettled.delete()
+        expected = {
+            'active_users': 2, 'messages_in': 2, 'messages_out': 1, 'delivered': 1, 'read': 1,
+            'replies': 1, 'reply_latency': 30.0,
+        }
+        self.assertEqual(self.rollup(), expected)
+        self.assertEqual(self.rollup(ConversationRollup.DAY), expected)
+
+        # Only new messages are added, and users are only counted once per period
+        self.create('other', 100, received=False)
+        self.create('user', 120)
+        self.assertEqual(ConversationRollups().update(), 3)
+        self.assertEqual(self.rollup(), dict(expected, messages_in=4, messages_out=2, replies=2, reply_latency=40.0))
+        self.assertEqual(ConversationRollups().update(), 0)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.start = datetime(2016, 5, 1, 12, tzinfo=timezone.utc)
+        for i in range(5):
+            BotMessage.objects.create(bot_id='user', timestamp=self.start + timedelta(days=i),
+                                      payload={'message': {'text': 'caf\u00e9 %d' % i}})
+        BotMessage.objects.create(bot_id='other', timestamp=self.start)
+
+    def export(self, filename, *args, **options):
+        path = os.path.join(self.directory, filename)
+        call_command('export', 'messages', path, *args, chunk_size=2, stdout=StringIO(), **options)
+        return path
+
+    def test_exports_ndjson_in_chunks(self):
+        path = self.export('out.ndjson', bot_id='user', end=(self.start + timedelta(days=4)).isoformat())
+        with open(path, 'rb') as f:
+            records = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual([r['payload']['message']['text'] for r in records], ['caf\u00e9 %d' % i for i in range(4)])
+        self.assertEqual(set(r['bot_id'] for r in records), set(['user']))
+
+    def test_exports_gzipped_csv(self):
+        path = self.export('out.csv.gz', format='csv', gzip=True)
+        with gzip.open(path, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+        rows = list(csv.reader([line.encode('utf-8') if six.PY2 else line for line in lines]))
+        self.assertEqual(rows[0], export.field_names(BotMessage))
+        self.assertEqual(len(rows), 7)
+
+    def test_splits_parts(self):
+        self.assertEqual(export.part_path('/tmp/out.ndjson.gz', 1), '/tmp/out.part1.ndjson.gz')
+        points = export.Command().split_points({'model': 'messages'}, 3)
+        ids = list(BotMessage.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(points, [ids[2], ids[4]])
+
+
+class TaskRoutingTests(SimpleTestCase):
+    def queue(self, name):
+        return current_app.amqp.router.route({}, name)['queue'].name
+
+    def test_every_bot_task_has_its_queue(self):
+        queues = set(queue.name for queue in current_app.conf.CELERY_QUEUES)
+        bot_tasks = [name for name, task in current_app.tasks.items() if task.__module__ == tasks.__name__]
+        self.assertEqual(set(bot_tasks), set(current_app.conf.CELERY_ROUTES))
+        for name in bot_tasks:
+            self.assertIn(self.queue(name), queues)
+
+    def test_replies_dont_wait_behind_logging(self):
+        self.assertEqual(self.queue('handle_payload'), 'replies')
+        self.assertEqual(self.queue('log_payload'), 'logging')
+        self.assertEqual(self.queue('rollup_messages'), 'maintenance')
+
+
+class FakeAsyncTask(object):
+    def __init__(self, name, sent):
+        self.name = name
+        self.sent = sent
+
+    def apply_async(self, args, headers=None):
+        self.sent.append(self.name)
+
+
+class WebhookTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.originals = views.handle_payload, views.log_payload, views.verify_request
+        views.handle_payload = FakeAsyncTask('handle_payload', self.sent)
+        views.log_payload = FakeAsyncTask('log_payload', self.sent)
+        views.verify_request = lambda request: True
+
+    def tearDown(self):
+        views.handle_payload, views.log_payload, views.verify_request = self.originals
+
+    def test_queues_handling_before_logging(self):
+        request = RequestFactory().post('/', data=webhook_payload(message_event('user', 'mid-1')),
+                                        content_type='application/json')
+        self.assertEqual(views.webhook(request).status_code, 200)
+        self.assertEqual(self.sent, ['handle_payload', 'log_payload'])
+
+
+class ListExporter(object):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class FakeRequest(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class TraceTests(SimpleTestCase):
+    def setUp(self):
+        self.exporter = ListExporter()
+        self.original = trace.exporter
+        trace.exporter = self.exporter
+
+    def tearDown(self):
+        trace.exporter = self.original
+
+    def names(self):
+        return [s.name for s in self.exporter.spans]
+
+    def test_nested_spans(self):
+        with trace.span('webhook') as root:
+            with trace.span('graph.send', sender='user') as child:
+                self.assertIs(trace.current_span(), child)
+            self.assertIs(trace.current_span(), root)
+        self.assertIsNone(trace.current_span())
+
+        self.assertEqual(self.names(), ['graph.send', 'webhook'])
+        self.assertEqual((child.trace_id, child.parent_id), (root.trace_id, root.span_id))
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(child.serialize()['tags'], {'sender': 'user'})
+
+    def test_tasks_continue_the_trace(self):
+        with trace.span('webhook') as root:
+            headers = trace.task_headers()
+        self.assertEqual(trace.task_headers(), {})
+
+        with trace.task_span('handle_payload', FakeRequest(headers)) as task:
+            pass
+        self.assertEqual(self.names(), ['webhook', 'broker', 'handle_payload'])
+        broker = self.exporter.spans[1]
+        self.assertEqual((broker.trace_id, broker.parent_id), (root.trace_id, root.span_id))
+        self.assertEqual((task.trace_id, task.parent_id), (root.trace_id, root.span_id))
+
+    def test_threads_continue_the_trace(self):
+        with trace.span('webhook') as root:
+            parent = trace.current_span()
+
+            def work():
+                with trace.continue_span(parent), trace.span('handle'):
+                    pass
+
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.assertEqual(self.exporter.spans[0].parent_id, root.span_id)
+
+
+class FakePostback(object):
+    def __init__(self, payload):
+        self.postback = {'payload': payload}
+
+
+class PostbackRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = PostbackRouter()
+
+        @self.router.route('get_started')
+        def get_started(handler, event):
+            return 'welcome'
+
+        @self.router.route('menu_item', int, str)
+        def menu_item(handler, event, item_id, size):
+            return item_id, size
+
+    def test_dispatches_by_name_with_converted_arguments(self):
+        self.assertEqual(self.router.dispatch(None, FakePostback('get_started,')), 'welcome')
+        self.assertEqual(self.router.dispatch(None, FakePostback('menu_item,5,large')), (5, 'large'))
+
+    def test_counts_unmatched_payloads(self):
+        for payload in ('menu_item,five,large', 'menu_item,5', 'unknown,1', ''):
+            self.assertIsNone(self.router.dispatch(None, FakePostback(payload)))
+        self.assertEqual(self.router.unmatched, {'menu_item': 2, 'unknown': 1, '': 1})
+
+    def test_rejects_bad_routes(self):
+        with self.assertRaises(ValueError):
+            self.router.route('menu_item')(lambda handler, event: None)
+        with self.assertRaises(ValueError):
+            self.router.route('menu,item')
+
+
+class FakePersistTask(object):
+    def __init__(self):
+        self.sent = []
+
+    def apply_async(self, args, countdown=None):
+        self.sent.append(args[0])
+
+
+class StateMachineTests(TestCase):
+    def setUp(self):
+        self.machine = state.StateMachine('idle')
+        self.machine.transition('order', 'idle', 'choosing')
+        self.machine.transition('choose', 'choosing', 'confirming')
+        self.machine.transition('cancel', state.ANY, 'idle')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_transitions(self):
+        conversation = self.machine.load('user')
+        self.assertEqual((conversation.state, conversation.version), ('idle', 0))
+        self.assertEqual(self.machine.triggers('choosing'), set(['choose', 'cancel']))
+
+        conversation = self.machine.fire(conversation, 'order')
+        conversation = self.machine.fire(conversation, 'choose', item_id=3)
+        with self.assertRaises(state.InvalidTransition):
+            self.machine.fire(conversation, 'order')
+
+        conversation = self.machine.load('user')
+        self.assertEqual(
+            (conversation.state, conversation.data, conversation.version), ('confirming', {'item_id': 3}, 2)
+        )
+        self.assertEqual(self.machine.fire(conversation, 'cancel').state, 'idle')
+
+    def test_conflicting_changes_without_shared_cache(self):
+        self.assertFalse(state.cache_is_shared())
+        first = self.machine.load('user')
+        second = self.machine.load('user')
+        self.machine.fire(first, 'order')
+        with self.assertRaises(state.StateConflict):
+            self.machine.fire(second, 'order')
+        self.assertEqual(BotConversationState.objects.get(bot_id='user').version, 1)
+
+    def test_expired_conversations_restart(self):
+        self.machine.fire(self.machine.load('user'), 'order')
+        BotConversationState.objects.update(updated_at=timezone.now() - timedelta(seconds=self.machine.ttl + 1))
+
+        conversation = self.machine.load('user')
+        self.assertEqual((conversation.state, conversation.version), ('idle', 1))
+        self.assertEqual(self.machine.fire(conversation, 'order').version, 2)
+
+        BotConversationState.objects.update(updated_at=timezone.now() - timedelta(seconds=self.machine.ttl + 1))
+        state.StateMachine.expire()
+        self.assertFalse(BotConversationState.objects.exists())
+
+    def test_conflicting_changes_with_shared_cache(self):
+        task = FakePersistTask()
+        originals = state.cache_is_shared, tasks.persist_conversation_state
+        state.cache_is_shared = lambda: True
+        tasks.persist_conversation_state = task
+        try:
+            first = self.machine.load('user')
+            second = self.machine.load('user')
+            conversation = self.machine.fire(first, 'order')
+            with self.assertRaises(state.StateConflict):
+                self.machine.fire(second, 'order')
+            self.machine.fire(conversation, 'choose')
+
+            # Written behind the cache once
+            self.assertEqual(task.sent, ['user'])
+            self.assertFalse(BotConversationState.objects.exists())
+            state.StateMachine.persist('user')
+            self.assertEqual(BotConversationState.objects.get(bot_id='user').state, 'confirming')
+        finally:
+            state.cache_is_shared, tasks.persist_conversation_state = originals
@@ -3,5 +3,6 @@ from django.conf.urls import url
 from . import views
 
 urlpatterns = [
+    url(r'^history/(?P<bot_id>[^/]+)/$', views.history, name='history'),
     url(r'^', views.webhook, name='webhook'),
 ]
@@ -0,0 +1,205 @@
+from collections import defaultdict
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from ..models import (
+    BotMessage,
+    BotWatermark,
+    ConversationRollup,
+    ConversationRollupState,
+    ConversationRollupUser,
+)
+from ..routers import use_primary
+
+logger = logging.getLogger(__name__)
+
+PERIODS = (
+    (ConversationRollup.DAY, lambda dt: dt.replace(hour=0, minute=0, second=0, microsecond=0)),
+    (ConversationRollup.HOUR, lambda dt: dt.replace(minute=0, second=0, microsecond=0)),
+)
+
+
+class ConversationRollups(object):
+    """ConversationRollups
+
+    Class for incrementally rolling up BotMessages into per day and per hour ConversationRollups.
+
+    Every update only reads the messages logged since the last one, by id, and adds them to the
+    rollups. A message is only rolled up once it's older than BOT_ROLLUP_SETTLE seconds, so that
+    its delivery and read receipts have usually arrived by then.
+
+    The reply latency of a user's message is the time until the next message we send them.
+
+    Parameters
+    ----------
+    batch_size: int
+        messages rolled up per transaction
+    """
+    STATE_NAME = 'conversation'
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.BOT_ROLLUP_BATCH_SIZE
+        # bot_id -> timestamp of the oldest message of the user not replied to yet
+        self.unanswered = {}
+
+    def update(self):
+        """update
+
+        Rolls up the settled messages logged since the last update.
+
+        Returns
+        -------
+        count: int
+            number of messages rolled up
+        """
+        # Reads its own writes and must not lag behind them, so stay on the primary
+        with use_primary():
+            settled = timezone.now() - timedelta(seconds=settings.BOT_ROLLUP_SETTLE)
+            state, _ = ConversationRollupState.objects.get_or_create(name=self.STATE_NAME)
+
+            count = 0
+            while True:
+                # Messages are logged in roughly, not strictly, timestamp order, so stop at the first
+                # unsettled one rather than skipping it
+                bms = list(
+                    BotMessage.objects.filter(id__gt=state.last_id).order_by('id')
+                    .only('id', 'bot_id', 'timestamp', 'received', 'delivered_time', 'read_time')[:self.batch_size]
+                )
+                unsettled = [i for i, bm in enumerate(bms) if bm.timestamp >= settled]
+                if unsettled:
+                    bms = bms[:unsettled[0]]
+                if not bms:
+                    break
+
+                self.rollup(bms, state)
+                count += len(bms)
+                if unsettled or len(bms) < self.batch_size:
+                    break
+
+            ConversationRollupUser.objects.filter(start__lt=settled - timedelta(days=1)).delete()
+            logger.info("Rolled up %d messages", count)
+            return count
+
+    def rollup(self, bms, state):
+        """rollup
+
+        Adds a batch of messages to the rollups and moves the high-water mark past them.
+        """
+        if settings.BOT_MESSAGE_RECEIPTS == 'watermark':
+            bot_ids = set(bm.bot_id for bm in bms if bm.sent)
+            watermarks = dict((w.bot_id, w) for w in BotWatermark.objects.filter(bot_id__in=bot_ids))
+            for bm in bms:
+                bm._watermark = watermarks.get(bm.bot_id)
+
+        counters = defaultdict(lambda: defaultdict(int))
+        users = defaultdict(set)
+        for bm in bms:
+            latency = self.reply_latency(bm)
+
+            for period, truncate in PERIODS:
+                key = (period, truncate(bm.timestamp))
+                c = counters[key]
+                if bm.received:
+                    c['messages_in'] += 1
+                    users[key].add(bm.bot_id)
+                else:
+                    c['messages_out'] += 1
+                    c['delivered'] += int(bm.delivered)
+                    c['read'] += int(bm.read)
+                    if latency is not None:
+                        c['replies'] += 1
+                        c['reply_latency'] += latency
+
+        with transaction.atomic():
+            for (period, start), c in counters.items():
+                c['active_users'] = self.add_active_users(period, start, users[(period, start)])
+
+                rollup, _ = ConversationRollup.objects.get_or_create(period=period, start=start)
+                ConversationRollup.objects.filter(pk=rollup.pk).update(**dict(
+                    (field, F(field) + value) for field, value in c.items() if value
+                ))
+
+            state.last_id = bms[-1].id
+            state.save()
+
+    def add_active_users(self, period, start, bot_ids):
+        """add_active_users
+
+        Records users as active in a period.
+
+        Returns
+        -------
+        count: int
+            number of users that weren't active in the period yet
+        """
+        if not bot_ids:
+            return 0
+
+        seen = set(
+            ConversationRollupUser.objects.filter(period=period, start=start, bot_id__in=bot_ids)
+            .values_list('bot_id', flat=True)
+        )
+        new = bot_ids - seen
+        ConversationRollupUser.objects.bulk_create([
+            ConversationRollupUser(period=period, start=start, bot_id=bot_id) for bot_id in new
+        ])
+        return len(new)
+
+    def reply_latency(self, bm):
+        """reply_latency
+
+        Latency of a message we sent, in seconds, if it's a reply to a message of the user.
+        Otherwise None.
+        """
+        if bm.received:
+            self.unanswered.setdefault(bm.bot_id, bm.timestamp)
+            return None
+
+        if bm.bot_id not in self.unanswered:
+            # First time we see the user in this update, look at what came before
+            with use_primary():
+                previous = (
+                    BotMessage.objects.filter(bot_id=bm.bot_id, timestamp__lte=bm.timestamp, id__lt=bm.id)
+                    .order_by('-timestamp', '-id').only('timestamp', 'received').first()
+                )
+            self.unanswered[bm.bot_id] = previous.timestamp if previous and previous.received else None
+
+        asked_at, self.unanswered[bm.bot_id] = self.unanswered[bm.bot_id], None
+        if asked_at is None:
+            return None
+        return (bm.timestamp - asked_at).total_seconds()
+
+
+def conversation_stats(period=ConversationRollup.DAY, start=None, end=None):
+    """conversation_stats
+
+    Returns the conversation statistics between start and end, read from the rollups only.
+
+    Parameters
+    ----------
+    period: string
+        ConversationRollup.DAY or ConversationRollup.HOUR
+
+    start: datetime
+        only periods starting at or after start
+
+    end: datetime
+        only periods starting before end
+
+    Returns
+    -------
+    stats: list of dicts
+        serialized ConversationRollups, oldest first
+    """
+    rollups = ConversationRollup.objects.filter(period=period)
+    if start is not None:
+        rollups = rollups.filter(start__gte=start)
+    if end is not None:
+        rollups = rollups.filter(start__lt=end)
+
+    return [rollup.serialize() for rollup in rollups]
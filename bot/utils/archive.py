@@ -0,0 +1,240 @@
+from datetime import (
+    datetime,
+    timedelta,
+)
+import glob
+import gzip
+import heapq
+from itertools import groupby
+import json
+import logging
+import os
+import re
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import BotMessage
+from ..routers import use_primary
+from .retention import MessageCleaner
+
+logger = logging.getLogger(__name__)
+
+
+class NDJSONArchiver(object):
+    """NDJSONArchiver
+
+    Class for archiving messages to a gzipped newline delimited json file, one serialized
+    BotMessage per line. Archiving to an existing file appends to it.
+
+    Parameters
+    ----------
+    path: string
+        path of the archive file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def archive(self, bms):
+        with gzip.open(self.path, 'ab') as f:
+            for bm in bms:
+                f.write(json.dumps(bm.serialize()).encode('utf-8'))
+                f.write(b'\n')
+
+
+def month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def previous_month(dt):
+    return month_start(month_start(dt) - timedelta(days=1))
+
+
+def next_month(dt):
+    if dt.month == 12:
+        return dt.replace(year=dt.year + 1, month=1)
+    return dt.replace(month=dt.month + 1)
+
+
+class MessageArchive(object):
+    """MessageArchive
+
+    Class for time partitioned message storage.
+
+    Messages are partitioned by calendar month (UTC). The months within BOT_MESSAGE_HOT_MONTHS
+    of the current one are hot and live in the BotMessage table. Older months are sealed: their
+    messages are exported to compressed segment files in the archive directory, one or more per
+    month, and deleted from the table. Sealed months can still be read, read-only, through
+    messages().
+
+    Segment files are gzipped newline delimited json named botmessage-YYYY-MM-<n>.ndjson.gz.
+
+    Parameters
+    ----------
+    directory: string
+        directory of the segment files, defaults to BOT_MESSAGE_ARCHIVE_DIR
+    """
+    SEGMENT_PATTERN = re.compile(r'^botmessage-(\d{4})-(\d{2})-(\d+)\.ndjson\.gz$')
+
+    def __init__(self, directory=None):
+        self.directory = directory or settings.BOT_MESSAGE_ARCHIVE_DIR
+        if not self.directory:
+            raise ValueError('<MessageArchive> directory or BOT_MESSAGE_ARCHIVE_DIR must be set')
+
+    @property
+    def boundary(self):
+        """boundary
+
+        Start of the oldest hot month. Messages before it belong to sealed months.
+        """
+        month = month_start(timezone.now())
+        for _ in range(settings.BOT_MESSAGE_HOT_MONTHS - 1):
+            month = previous_month(month)
+        return month
+
+    def segments(self, month=None):
+        """segments
+
+        Returns the sorted segment paths, optionally of a single month (a datetime).
+        """
+        paths = []
+        for path in glob.glob(os.path.join(self.directory, 'botmessage-*.ndjson.gz')):
+            match = self.SEGMENT_PATTERN.match(os.path.basename(path))
+            if not match:
+                continue
+            year, mon, n = (int(g) for g in match.groups())
+            if month is not None and (year, mon) != (month.year, month.month):
+                continue
+            paths.append(((year, mon, n), path))
+        return [path for _, path in sorted(paths)]
+
+    def seal(self):
+        """seal
+
+        Seals every month before the boundary that still has messages in the table.
+
+        Returns
+        -------
+        count: int
+            number of messages archived
+        """
+        # Months are found right after purging the previous ones, a lagging replica would return them again
+        with use_primary():
+            count = 0
+            boundary = self.boundary
+            while True:
+                oldest = BotMessage.objects.filter(timestamp__lt=boundary).order_by('timestamp').first()
+                if oldest is None:
+                    return count
+                count += self.seal_month(month_start(oldest.timestamp))
+
+    def seal_month(self, month):
+        """seal_month
+
+        Exports the messages of a month to a new segment file, then deletes them from the table.
+
+        Messages are exported oldest first, by (timestamp, id). Only the ids read back from the
+        segment are deleted, so messages of that month logged while sealing stay in the table
+        until the next seal.
+        """
+        with use_primary():
+            qs = BotMessage.objects.filter(
+                timestamp__gte=month, timestamp__lt=next_month(month)
+            ).order_by('timestamp', 'id')
+
+            n = len(self.segments(month))
+            path = os.path.join(self.directory, 'botmessage-%04d-%02d-%d.ndjson.gz' % (month.year, month.month, n))
+            tmp_path = path + '.tmp'
+
+            count = 0
+            last = None
+            with gzip.open(tmp_path, 'wb') as f:
+                while True:
+                    chunk_qs = qs
+                    if last is not None:
+                        timestamp, id = last
+                        chunk_qs = qs.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=id))
+
+                    chunk = list(chunk_qs[:settings.BOT_MESSAGE_RETENTION_CHUNK_SIZE])
+                    if not chunk:
+                        break
+                    for bm in chunk:
+                        f.write(json.dumps(bm.serialize()).encode('utf-8'))
+                        f.write(b'\n')
+                    count += len(chunk)
+                    last = (chunk[-1].timestamp, chunk[-1].id)
+
+            if not count:
+                os.remove(tmp_path)
+                return 0
+
+            # Segment is only visible once complete
+            os.rename(tmp_path, path)
+            MessageCleaner().purge_ids(record['id'] for record in self.read_segment(path))
+
+            logger.info("Sealed %d messages of %s into %s", count, month.strftime('%Y-%m'), path)
+            return count
+
+    def messages(self, start=None, end=None, bot_id=None):
+        """messages
+
+        Reads archived messages, read-only.
+
+        Parameters
+        ----------
+        start: datetime
+            only messages at or after start
+
+        end: datetime
+            only messages before end
+
+        bot_id: string
+            only messages of the given user
+
+        Returns
+        -------
+        messages: generator of BotMessage objects
+            unsaved messages, oldest first by (timestamp, id)
+        """
+        for month, paths in groupby(self.segments(), self.segment_month):
+            if (end is not None and month >= end) or (start is not None and next_month(month) <= start):
+                continue
+
+            # Each segment is in (timestamp, id) order, so those of a month are merged. They can
+            # overlap if sealing was interrupted, skip repeated ids
+            seen = set()
+            segments = [self.read_messages(path, start, end, bot_id) for path in paths]
+            for _, bm in heapq.merge(*segments):
+                if bm.id in seen:
+                    continue
+                seen.add(bm.id)
+                yield bm
+
+    def segment_month(self, path):
+        year, mon, _ = (int(g) for g in self.SEGMENT_PATTERN.match(os.path.basename(path)).groups())
+        return datetime(year, mon, 1, tzinfo=timezone.utc)
+
+    def read_messages(self, path, start, end, bot_id):
+        """read_messages
+
+        Yields ((timestamp, id, path), message) of the messages of a segment file within start,
+        end and bot_id, see messages().
+        """
+        for record in self.read_segment(path):
+            if bot_id is not None and record['bot_id'] != bot_id:
+                continue
+
+            bm = BotMessage.deserialize(record)
+            if (start is not None and bm.timestamp < start) or (end is not None and bm.timestamp >= end):
+                continue
+            yield (bm.timestamp, bm.id, path), bm
+
+    def read_segment(self, path):
+        """read_segment
+
+        Yields the serialized messages of a segment file.
+        """
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                yield json.loads(line.decode('utf-8'))
@@ -0,0 +1,199 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyController(object):
+    """ConcurrencyController
+
+    Class for adapting the pool size of the workers of a queue to its depth and latency.
+
+    Every tick finds the workers consuming the queue, samples the queue depth and the number of
+    tasks those workers have processed, and estimates the queue latency by Little's law
+    (depth / throughput). The pool of each worker is grown by step processes when the latency is
+    above target_latency, and shrunk by step when it's below target_latency * hysteresis, always
+    within min_size and max_size per worker. Between the two thresholds nothing changes, and no
+    change is made within cooldown seconds of the last one, so the pools don't flap.
+
+    The samplers and the resizer default to the broker and celery remote control, but can be
+    replaced, e.g. to test decisions against an in-memory broker (memory://).
+
+    Parameters
+    ----------
+    app: Celery object
+        the celery app
+
+    queue: string
+        name of the queue to watch
+
+    destination: list of strings
+        node names of the workers to resize, or None for all the workers consuming the queue
+
+    min_size, max_size: int
+        bounds of the pool size of each worker
+
+    target_latency: float
+        seconds a task may wait in the queue
+
+    step: int
+        processes added or removed per change
+
+    hysteresis: float
+        fraction of target_latency under which the pool is shrunk
+
+    cooldown: float
+        min seconds between two changes
+    """
+    def __init__(self, app, queue, destination=None, min_size=1, max_size=8, target_latency=5.0,
+                 step=1, hysteresis=0.5, cooldown=30.0):
+        if not 0 < min_size <= max_size:
+            raise ValueError('<ConcurrencyController> must have 0 < min_size <= max_size')
+
+        self.app = app
+        self.queue = queue
+        self.destination = destination
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.step = step
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+
+        self.changed_at = None
+        self.last_sample = None
+        self.metrics = {
+            'depth': 0,
+            'throughput': 0.0,
+            'latency': 0.0,
+            'workers': 0,
+            'pool_size': None,
+            'decision': {},
+            'grown': 0,
+            'shrunk': 0,
+        }
+
+    """Samplers
+
+    The following sample the queue and the workers. Override them to use other sources.
+    """
+
+    def sample_depth(self):
+        with self.app.connection() as connection:
+            return connection.default_channel.queue_declare(queue=self.queue, passive=True).message_count
+
+    def sample_destinations(self):
+        """sample_destinations
+
+        Returns the node names of the workers consuming the queue, among destination if it's set.
+        """
+        active_queues = self.app.control.inspect(destination=self.destination).active_queues() or {}
+        return sorted(
+            node for node, queues in active_queues.items()
+            if any(q.get('name') == self.queue for q in queues)
+        )
+
+    def sample_workers(self, destinations):
+        """sample_workers
+
+        Returns the total number of tasks processed by the given workers, and the pool size of
+        each one.
+        """
+        if not destinations:
+            return 0, {}
+        stats = self.app.control.inspect(destination=destinations).stats() or {}
+        processed = sum(sum(s.get('total', {}).values()) for s in stats.values())
+        pool_sizes = dict(
+            (node, s.get('pool', {}).get('max-concurrency', 0)) for node, s in stats.items()
+        )
+        return processed, pool_sizes
+
+    def resize(self, node, delta):
+        if delta > 0:
+            self.app.control.pool_grow(delta, destination=[node])
+        elif delta < 0:
+            self.app.control.pool_shrink(-delta, destination=[node])
+
+    """Control loop"""
+
+    def decide(self, latency, pool_size, now):
+        """decide
+
+        Returns the change of pool size of a worker for the given latency and its pool size.
+        """
+        if self.changed_at is not None and now - self.changed_at < self.cooldown:
+            return 0
+
+        if pool_size < self.min_size:
+            return self.min_size - pool_size
+        if pool_size > self.max_size:
+            return self.max_size - pool_size
+
+        if latency > self.target_latency:
+            return min(self.step, self.max_size - pool_size)
+        if latency < self.target_latency * self.hysteresis:
+            return -min(self.step, pool_size - self.min_size)
+        return 0
+
+    def tick(self):
+        """tick
+
+        Samples, decides and applies one change to each worker of the queue.
+
+        Returns
+        -------
+        deltas: dict
+            the change of pool size of each worker
+        """
+        now = time.time()
+        depth = self.sample_depth()
+        destinations = self.sample_destinations()
+        processed, pool_sizes = self.sample_workers(destinations)
+
+        # Throughput needs two samples of the same workers, the count restarts with a worker
+        first_sample = self.last_sample is None or self.last_sample[2] != set(pool_sizes)
+        throughput = 0.0
+        if not first_sample:
+            last_time, last_processed, _ = self.last_sample
+            throughput = max(processed - last_processed, 0) / max(now - last_time, 1e-9)
+        self.last_sample = (now, processed, set(pool_sizes))
+
+        if not depth:
+            latency = 0.0
+        elif throughput:
+            latency = depth / throughput
+        else:
+            latency = float('inf')
+
+        deltas = {}
+        for node, pool_size in sorted(pool_sizes.items()):
+            deltas[node] = 0 if first_sample else self.decide(latency, pool_size, now)
+            if deltas[node]:
+                self.resize(node, deltas[node])
+
+        if any(deltas.values()):
+            self.changed_at = now
+            self.metrics['grown' if sum(deltas.values()) > 0 else 'shrunk'] += 1
+
+        pool_size = sum(pool_sizes.values()) + sum(deltas.values())
+        self.metrics.update(
+            depth=depth,
+            throughput=throughput,
+            latency=latency,
+            workers=len(pool_sizes),
+            pool_size=pool_size,
+            decision=deltas,
+        )
+        logger.info(
+            "autoscale queue=%s depth=%d throughput=%.1f latency=%.1f workers=%d pool_size=%d decision=%s",
+            self.queue, depth, throughput, latency, len(pool_sizes), pool_size, deltas
+        )
+        return deltas
+
+    def run(self, interval=5.0):
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("autoscale queue=%s tick failed", self.queue)
+            time.sleep(interval)
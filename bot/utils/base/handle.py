@@ -1,23 +1,46 @@
 import logging
 import os
 import traceback
+from django.conf import settings
+from django.db import (
+    IntegrityError,
+    transaction,
+)
 from messenger import (
     MessengerClient,
     MessageRequest,
 )
 
 from ...models import BotUser
+from ...tasks import enrich_bot_user
+from ..cache import LRUCache
+from ..trace import span
 
 token = os.environ.get('PAGE_ACCESS_TOKEN')
 logger = logging.getLogger(__name__)
 
+# Identity cache of BotUsers by bot_id, shared by the handlers of a process
+bot_user_cache = LRUCache(settings.BOT_USER_CACHE_SIZE, ttl=settings.BOT_USER_CACHE_TTL)
+
 
 class BaseMessageHandler(object):
     """BaseMessageHandler
 
     Base class for message handling. To handle each message case, inherit the class and
     override the handle methods with NotImplemented.
+
+    Postbacks can instead be dispatched by their payload, by setting postback_router to a
+    PostbackRouter (see utils/routing.py).
+
+    Text can be matched to intents by setting intent_matcher to an IntentMatcher (see
+    utils/intents.py) and calling match_intent.
+
+    Multi-step conversations can keep per user state by setting state_machine to a
+    StateMachine (see utils/state.py) and calling get_conversation.
     """
+    postback_router = None
+    intent_matcher = None
+    state_machine = None
 
     """Properties
 
@@ -32,7 +55,8 @@ class BaseMessageHandler(object):
 
     """Bot user utilities
 
-    The following are helpers for getting and creating a bot user.
+    The following are helpers for getting and creating a bot user. Bot users are kept in
+    bot_user_cache, so getting a known user usually doesn't hit the database.
     """
 
     def get_bot_user(self, sender):
@@ -50,15 +74,24 @@ class BaseMessageHandler(object):
         bot_user: BotUser object
             the corresponding bot user or None
         """
-        try:
-            return BotUser.objects.get(bot_id=sender.id)
-        except BotUser.DoesNotExist:
-            return None
+        bot_user = bot_user_cache.get(sender.id)
+        if bot_user is None:
+            try:
+                bot_user = BotUser.objects.get(bot_id=sender.id)
+            except BotUser.DoesNotExist:
+                return None
+            bot_user_cache.set(sender.id, bot_user)
+
+        return bot_user
 
     def create_bot_user(self, sender):
         """create_bot_user
 
-        Creates a bot user
+        Creates a bot user, or gets it if it was created concurrently.
+
+        The user's profile is fetched in the background by the enrich_bot_user task, so it isn't
+        available on the returned bot user yet. The task is sent once the user is committed, so
+        it can't run before the user is visible to it.
 
         Parameters
         ----------
@@ -70,12 +103,34 @@ class BaseMessageHandler(object):
         bot_user: BotUser object
             the created bot user
         """
-        bot_user = BotUser(bot_id=sender.id)
-        bot_user.set_user_fields()
-        bot_user.save()
+        try:
+            with transaction.atomic():
+                bot_user = BotUser.objects.create(bot_id=sender.id)
+        except IntegrityError:
+            bot_user = BotUser.objects.get(bot_id=sender.id)
+        else:
+            transaction.on_commit(lambda: enrich_bot_user.apply_async((sender.id,)))
 
+        bot_user_cache.set(sender.id, bot_user)
         return bot_user
 
+    def get_or_create_bot_user(self, sender):
+        """get_or_create_bot_user
+
+        Gets corresponding bot user, creating it if it doesn't exist.
+
+        Parameters
+        ----------
+        sender: Sender object
+            the sender of the event, contained in self.event.sender
+
+        Returns
+        -------
+        bot_user: BotUser object
+            the corresponding bot user
+        """
+        return self.get_bot_user(sender) or self.create_bot_user(sender)
+
     def send_message(self, sender, message):
         """send_message
 
@@ -92,7 +147,8 @@ class BaseMessageHandler(object):
         def send(m):
             request = MessageRequest(recipient=sender, message=m)
             try:
-                return self.client.send(request)
+                with span('graph.send'):
+                    return self.client.send(request)
             except:
                 logger.error(traceback.format_exc())
 
@@ -103,6 +159,44 @@ class BaseMessageHandler(object):
         else:
             send(message)
 
+    def match_intent(self, event):
+        """match_intent
+
+        Matches the text of a message against intent_matcher.
+
+        Parameters
+        ----------
+        event: Event object
+            a message event containing text
+
+        Returns
+        -------
+        match: IntentMatch object
+            the match of the highest priority rule, or None
+        """
+        if self.intent_matcher is None:
+            return None
+        return self.intent_matcher.match(event.message.get('text'))
+
+    def get_conversation(self, sender):
+        """get_conversation
+
+        Gets the conversation state of the event sender from state_machine.
+
+        Parameters
+        ----------
+        sender: Sender object
+            the sender of the event, contained in self.event.sender
+
+        Returns
+        -------
+        conversation: Conversation object
+            the sender's conversation, or None if state_machine isn't set
+        """
+        if self.state_machine is None:
+            return None
+        return self.state_machine.load(sender.id)
+
     """Message handling utilities
 
     The following are helpers for handling all types of receivable messages.
@@ -125,9 +219,11 @@ class BaseMessageHandler(object):
         # Call appropriate message handler
         message = None
         if event.is_received:
-            message = self.handle_received(event)
+            with span('handler.received'):
+                message = self.handle_received(event)
         elif event.is_postback:
-            message = self.handle_postback(event)
+            with span('handler.postback'):
+                message = self.handle_postback(event)
         else:
             return
 
@@ -185,5 +281,8 @@ class BaseMessageHandler(object):
         """handle_postback
 
         Handles a postback, which are those in which a user taps a button.
+
+        Dispatches the postback through postback_router if it's set.
         """
-        pass
+        if self.postback_router is not None:
+            return self.postback_router.dispatch(self, event)
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """LRUCache
+
+    Thread safe in-process cache that holds up to maxsize items, evicting the least recently
+    used one when full.
+
+    Parameters
+    ----------
+    maxsize: int
+        max number of items
+
+    ttl: float
+        seconds after which an item expires, or None to keep items until they're evicted
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.items.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= time.time():
+                return default
+
+            # Reinsert as most recently used
+            self.items[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, expires)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,131 @@
+import glob
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Every record: header (received time, signature length, body length), signature, body
+RECORD_HEADER = struct.Struct('>dII')
+
+
+class SegmentWriter(object):
+    """SegmentWriter
+
+    Class for capturing raw webhook requests into append-only segment files.
+
+    Each record is the received time, the X-Hub-Signature header and the raw body, length
+    prefixed so segments can be read back without parsing (see iter_segment). A new segment is
+    started when the current one reaches max_size bytes.
+
+    Parameters
+    ----------
+    directory: string
+        directory of the segment files
+
+    max_size: int
+        size in bytes after which a new segment is started
+    """
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.file = None
+
+    def open_segment(self):
+        if self.file is not None:
+            self.file.close()
+
+        filename = 'webhook-%d-%d.seg' % (int(time.time() * 1000), os.getpid())
+        self.file = open(os.path.join(self.directory, filename), 'ab')
+
+    def write(self, body, signature, received_at=None):
+        if received_at is None:
+            received_at = time.time()
+        signature = (signature or '').encode('ascii')
+
+        record = RECORD_HEADER.pack(received_at, len(signature), len(body)) + signature + body
+        with self.lock:
+            if self.file is None or self.file.tell() >= self.max_size:
+                self.open_segment()
+            self.file.write(record)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def segment_paths(paths):
+    """segment_paths
+
+    Expands directories into their segment files, in the order they were written.
+    """
+    segments = []
+    for path in paths:
+        if os.path.isdir(path):
+            segments.extend(sorted(glob.glob(os.path.join(path, 'webhook-*.seg'))))
+        else:
+            segments.append(path)
+    return segments
+
+
+def iter_segment(path):
+    """iter_segment
+
+    Reads the records of a segment file through a memory map.
+
+    Returns
+    -------
+    records: generator of (received_at, signature, body) tuples
+        signature and body as bytes. A record cut short, e.g. by a crash while writing, ends
+        the segment.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            size = len(data)
+            while offset + RECORD_HEADER.size <= size:
+                received_at, signature_length, body_length = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                end = offset + signature_length + body_length
+                if end > size:
+                    return
+
+                signature = data[offset:offset + signature_length]
+                body = data[offset + signature_length:end]
+                offset = end
+                yield received_at, signature, body
+        finally:
+            data.close()
+
+
+def iter_segments(paths):
+    """iter_segments
+
+    Reads the records of several segment files, merged by received time.
+
+    Every process writes its own segments, so segments of concurrent processes overlap in time.
+    Records within a segment are in received order, so merging them gives the captured order
+    across all of them.
+
+    Returns
+    -------
+    records: generator of (received_at, signature, body) tuples
+        as iter_segment
+    """
+    def keyed(i, path):
+        # Segment index breaks ties so bodies are never compared
+        for received_at, signature, body in iter_segment(path):
+            yield received_at, i, signature, body
+
+    segments = [keyed(i, path) for i, path in enumerate(paths)]
+    for received_at, _, signature, body in heapq.merge(*segments):
+        yield received_at, signature, body
@@ -0,0 +1,153 @@
+import logging
+import socket
+import time
+import traceback
+
+from django.db import (
+    InterfaceError,
+    OperationalError,
+    transaction,
+)
+from kombu import Consumer
+
+from ..routers import read_your_writes
+from .log import BufferedMessageLogger
+
+logger = logging.getLogger(__name__)
+
+# Database errors that logging the same payload again can get past
+TRANSIENT_ERRORS = (InterfaceError, OperationalError)
+
+
+def log_batch(payloads):
+    """log_batch
+
+    Logs the message events of several webhook payloads in a single transaction.
+    """
+    with read_your_writes(), transaction.atomic():
+        with BufferedMessageLogger(max_size=float('inf'), max_age=float('inf')) as mlogger:
+            for data in payloads:
+                mlogger.log_payload(data)
+
+
+class LogBatchConsumer(object):
+    """LogBatchConsumer
+
+    Class for consuming log_payload tasks in batches instead of one by one.
+
+    Pulls up to batch_size pending log_payload task messages from the logging queue, waiting at
+    most timeout seconds to fill a batch, logs them all in a single transaction through
+    BufferedMessageLogger, then acknowledges them together. If the batch can't be logged, its
+    tasks are logged one by one. Those that still fail are rejected, unless the database is
+    unavailable, in which case they are requeued.
+
+    Parameters
+    ----------
+    app: Celery object
+        the celery app, for its broker connection and queue declarations
+
+    batch_size: int
+        max number of tasks per batch
+
+    timeout: float
+        max seconds to wait for a batch to fill up
+    """
+    TASK_NAME = 'log_payload'
+    QUEUE_NAME = 'logging'
+
+    def __init__(self, app, batch_size=100, timeout=1.0):
+        self.app = app
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.batch = []
+
+    def on_message(self, body, message):
+        self.batch.append((body, message))
+
+    def task_args(self, body, message):
+        """task_args
+
+        Returns the task name and args of a celery task message, protocol 1 or 2.
+        """
+        headers = message.headers or {}
+        if 'task' in headers:
+            return headers['task'], body[0]
+        return body['task'], body['args']
+
+    def run(self):
+        queue = self.app.amqp.queues[self.QUEUE_NAME]
+        with self.app.connection() as connection:
+            consumer = Consumer(
+                connection,
+                queues=[queue],
+                callbacks=[self.on_message],
+                accept=self.app.conf.accept_content,
+            )
+            consumer.qos(prefetch_count=self.batch_size)
+            with consumer:
+                while True:
+                    self.fill(connection)
+                    if self.batch:
+                        self.process()
+
+    def fill(self, connection):
+        deadline = time.time() + self.timeout
+        while len(self.batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            try:
+                connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                return
+
+    def process(self):
+        batch, self.batch = self.batch, []
+
+        payloads = []
+        messages = []
+        for body, message in batch:
+            try:
+                name, args = self.task_args(body, message)
+                data = args[0]
+            except (KeyError, IndexError, TypeError):
+                name, data = None, None
+
+            if name != self.TASK_NAME:
+                logger.error("Rejecting unexpected task %r on the %s queue", name, self.QUEUE_NAME)
+                message.reject()
+                continue
+
+            payloads.append(data)
+            messages.append(message)
+
+        try:
+            log_batch(payloads)
+        except Exception:
+            logger.error(traceback.format_exc())
+            self.process_each(payloads, messages)
+            return
+
+        for message in messages:
+            message.ack()
+        logger.info("Logged a batch of %d payloads", len(messages))
+
+    def process_each(self, payloads, messages):
+        """process_each
+
+        Logs the payloads of a failed batch one by one, so a single bad payload doesn't fail the
+        others. Payloads that still fail because of a database outage are requeued. Those that
+        fail otherwise are rejected rather than requeued, since they would fail every batch
+        they come back in.
+        """
+        for data, message in zip(payloads, messages):
+            try:
+                log_batch([data])
+            except TRANSIENT_ERRORS:
+                logger.error(traceback.format_exc())
+                message.requeue()
+            except Exception:
+                logger.error(traceback.format_exc())
+                message.reject()
+            else:
+                message.ack()
@@ -1,31 +1,92 @@
+from collections import OrderedDict
 import json
 import logging
 import traceback
+from django.conf import settings
 from messenger import (
     Message,
     Webhook
 )
 
 from base.handle import BaseMessageHandler
+from .intents import IntentMatcher
+from .pool import GroupPool
+from .routing import PostbackRouter
+from .state import StateMachine
+from .trace import span
 
 logger = logging.getLogger(__name__)
 
+# Postback routes, see PostbackRouter in routing.py. For example:
+#
+# @postback_router.route('get_started')
+# def get_started(handler, event):
+#     return Message(text="Welcome to our bot!")
+#
+# @postback_router.route('menu_item', int)
+# def menu_item(handler, event, item_id):
+#     return Message(text="You picked menu item %d" % item_id)
+postback_router = PostbackRouter()
+
+# Text intents, see IntentMatcher in intents.py. For example:
+#
+# intent_matcher.keyword('greeting', ['hi', 'hello', 'good morning'])
+# intent_matcher.regex('order_status', r'where is my order #?\d+', priority=10)
+intent_matcher = IntentMatcher()
+
+# Conversation states, see StateMachine in state.py. For example:
+#
+# state_machine.transition('order', 'idle', 'choosing')
+# state_machine.transition('choose', 'choosing', 'confirming')
+# state_machine.transition('cancel', ANY, 'idle')
+state_machine = StateMachine('idle')
+
+# Threads handling the senders of a webhook batch concurrently, see GroupPool in pool.py
+handler_pool = GroupPool(settings.BOT_HANDLER_THREADS)
+
+
+def handle_events(sender_id, events):
+    """handle_events
+
+    Handles the events of a sender in order.
+    """
+    handler = MessageHandler()
+    for event in events:
+        try:
+            with span('event', sender=sender_id):
+                handler.handle(event)
+        except:
+            logger.error(traceback.format_exc())
+
 
 def handle_payload(data):
     """handle_payload
 
-    Asynchronous task to handle message event payload.
+    Handles message event payload, run by the handle_payload task in tasks.py.
+
+    Events are grouped by sender, and the groups of different senders are handled concurrently
+    on the BOT_HANDLER_THREADS threads of handler_pool, waiting at most BOT_HANDLER_DEADLINE
+    seconds.
     """
     payload = json.loads(data)
     wh = Webhook(payload)
 
-    handler = MessageHandler()
+    events = OrderedDict()
     for entry in wh.entries:
         for event in entry.messaging:
-            try:
-                handler.handle(event)
-            except:
-                logger.error(traceback.format_exc())
+            events.setdefault(event.sender.id, []).append(event)
+
+    if settings.BOT_HANDLER_THREADS <= 1 or len(events) <= 1:
+        for sender_id, sender_events in events.items():
+            handle_events(sender_id, sender_events)
+        return
+
+    unfinished = handler_pool.run(handle_events, events, settings.BOT_HANDLER_DEADLINE)
+    if unfinished:
+        logger.warning(
+            "Events of %d senders not handled within %ss: %s",
+            len(unfinished), settings.BOT_HANDLER_DEADLINE, ', '.join(unfinished)
+        )
 
 
 class MessageHandler(BaseMessageHandler):
@@ -63,7 +124,7 @@ class MessageHandler(BaseMessageHandler):
 
         Currently calls the parent's handle method (which is necessary), but use this to add
         handle defaults and customization such as:
-         - creating a user for some or all cases (see get_bot_user() and create_bot_user())
+         - creating a user for some or all cases (see get_or_create_bot_user())
          - logging specifc messages (setting the should_log for certain cases)
 
         Parameters
@@ -73,7 +134,7 @@ class MessageHandler(BaseMessageHandler):
         """
         # Attach bot user object to event for access later on
         # if event.is_received or event.is_postback:
-        #     event.bot_user = self.get_bot_user(event.sender) or self.create_bot_user(event.sender)
+        #     event.bot_user = self.get_or_create_bot_user(event.sender)
 
         return super(MessageHandler, self).handle(event=event)
 
@@ -81,7 +142,14 @@ class MessageHandler(BaseMessageHandler):
         """handle_received_text
 
         Handles a message that contains text. This can contain text, quick replies, etc.
+
+        Once rules are added to intent_matcher, set the intent_matcher attribute of the class to
+        it to match text with match_intent.
         """
+        # match = self.match_intent(event)
+        # if match and match.intent == 'greeting':
+        #     return Message(text="Hello there!")
+
         # if 'quick_reply' in event.message:
         #     text = "Thanks for the quick reply message!\n\n%s" % event.message['text']
         # else:
@@ -122,6 +190,9 @@ class MessageHandler(BaseMessageHandler):
         """handle_postback
 
         Handles a postback, which are those in which a user taps a button.
+
+        Once routes are registered on postback_router, set the postback_router attribute of
+        the class to it and remove this method to dispatch postbacks through the router.
         """
         # payload = event.postback['payload']
         # if payload.startswith('get_started,'):
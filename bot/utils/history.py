@@ -0,0 +1,142 @@
+import base64
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from ..models import BotMessage
+
+
+def encode_cursor(bm):
+    value = '%s|%d' % (bm.timestamp.isoformat(), bm.id)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """decode_cursor
+
+    Returns the (timestamp, id) keyset of a cursor, raises ValueError if it's invalid.
+    """
+    try:
+        timestamp, id = base64.urlsafe_b64decode(str(cursor)).decode('utf-8').split('|')
+        timestamp = parse_datetime(timestamp)
+        id = int(id)
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor %r' % cursor)
+
+    if timestamp is None:
+        raise ValueError('invalid cursor %r' % cursor)
+    return timestamp, id
+
+
+class HistoryPage(object):
+    """HistoryPage
+
+    A page of a conversation.
+
+    Attributes
+    ----------
+    messages: list of BotMessage objects
+        the messages of the page, most recent first
+
+    older: string
+        cursor for the page of older messages, or None if there isn't one
+
+    newer: string
+        cursor for the page of newer messages, or None if there isn't one
+    """
+    def __init__(self, messages, older=None, newer=None):
+        self.messages = messages
+        self.older = older
+        self.newer = newer
+
+    def serialize(self):
+        return {
+            'messages': [bm.serialize() for bm in self.messages],
+            'older': self.older,
+            'newer': self.newer,
+        }
+
+
+class ConversationHistory(object):
+    """ConversationHistory
+
+    Class for reading a user's conversation page by page.
+
+    Pages are keyed by (timestamp, id) rather than offsets, so reading a page costs the same no
+    matter how deep it is, and each page is a range scan of the (bot_id, timestamp) index.
+
+    Parameters
+    ----------
+    bot_id: string
+        the user whose conversation to read
+
+    page_size: int
+        messages per page, capped at BOT_HISTORY_MAX_PAGE_SIZE
+    """
+    def __init__(self, bot_id, page_size=None):
+        self.bot_id = bot_id
+        page_size = min(page_size or settings.BOT_HISTORY_PAGE_SIZE, settings.BOT_HISTORY_MAX_PAGE_SIZE)
+        self.page_size = max(page_size, 1)
+
+    def page(self, before=None, after=None):
+        """page
+
+        Returns a HistoryPage of the most recent messages, or of the messages before or after
+        the given cursor.
+
+        Parameters
+        ----------
+        before: string
+            cursor, the page holds the messages right before it
+
+        after: string
+            cursor, the page holds the messages right after it
+        """
+        if before and after:
+            raise ValueError('<ConversationHistory> before and after cannot both be set')
+
+        qs = BotMessage.objects.filter(bot_id=self.bot_id)
+        if after:
+            timestamp, id = decode_cursor(after)
+            qs = qs.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=id))
+            qs = qs.order_by('timestamp', 'id')
+        else:
+            if before:
+                timestamp, id = decode_cursor(before)
+                qs = qs.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id))
+            qs = qs.order_by('-timestamp', '-id')
+
+        # Fetch an extra message to know whether there's another page
+        messages = list(qs[:self.page_size + 1])
+        has_more = len(messages) > self.page_size
+        messages = messages[:self.page_size]
+
+        if after:
+            messages.reverse()
+            has_older, has_newer = True, has_more
+        else:
+            has_older, has_newer = has_more, bool(before)
+
+        if not messages:
+            return HistoryPage(messages)
+
+        return HistoryPage(
+            messages,
+            older=encode_cursor(messages[-1]) if has_older else None,
+            newer=encode_cursor(messages[0]) if has_newer else None,
+        )
+
+    def iter_messages(self, before=None):
+        """iter_messages
+
+        Iterates over the conversation, most recent first, one page at a time.
+        """
+        while True:
+            page = self.page(before=before)
+            for bm in page.messages:
+                yield bm
+
+            if not page.older:
+                return
+            before = page.older
@@ -0,0 +1,208 @@
+from __future__ import unicode_literals
+
+from collections import deque
+import re
+
+from .text import normalize
+
+# Python 2 regular expressions are limited to 100 named groups
+MAX_GROUPS_PER_PATTERN = 90
+
+
+class IntentMatch(object):
+    """IntentMatch
+
+    Attributes
+    ----------
+    intent: string
+        the matched intent
+
+    priority: int
+        priority of the rule that matched
+
+    start, end: int
+        span of the match in the normalized text
+    """
+    def __init__(self, intent, priority, start, end):
+        self.intent = intent
+        self.priority = priority
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return '<IntentMatch %s priority=%d span=(%d, %d)>' % (self.intent, self.priority, self.start, self.end)
+
+    def beats(self, other):
+        """beats
+
+        Higher priority wins, then the earliest match, then the longest one.
+        """
+        if other is None:
+            return True
+        return (self.priority, -self.start, self.end - self.start) > (other.priority, -other.start, other.end - other.start)
+
+
+class KeywordAutomaton(object):
+    """KeywordAutomaton
+
+    Aho-Corasick automaton finding all occurrences of a set of keywords in a single pass over
+    a text, whatever the number of keywords.
+    """
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, keyword, value):
+        node = 0
+        for c in keyword:
+            if c not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][c] = len(self.goto) - 1
+            node = self.goto[node][c]
+        self.output[node].append((len(keyword), value))
+
+    def build(self):
+        """build
+
+        Computes the failure links, breadth first. Must be called after adding keywords.
+        """
+        # Depth one nodes fail to the root, which they're initialized to
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(c, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text):
+        """search
+
+        Yields (start, end, value) of every keyword occurrence in text.
+        """
+        node = 0
+        for i, c in enumerate(text):
+            while node and c not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(c, 0)
+            for length, value in self.output[node]:
+                yield i + 1 - length, i + 1, value
+
+
+class IntentMatcher(object):
+    """IntentMatcher
+
+    Class for matching message text against many keyword and regex rules at once.
+
+    Keywords are compiled into a single Aho-Corasick automaton, so a text is scanned once no
+    matter how many keywords there are. Regexes are combined into one alternation per priority,
+    searched from the highest priority down until one matches. The
+    match of the highest priority rule is returned.
+
+    Texts and keywords are normalized (lowercased, accents stripped, whitespace collapsed, see
+    utils/text.py) and keywords only match whole words. Regexes are matched against the
+    normalized text, so they should be written in lowercase without accents, and can't use
+    numbered backreferences since they're combined.
+
+        matcher = IntentMatcher()
+        matcher.keyword('greeting', ['hi', 'hello', 'good morning'])
+        matcher.regex('order_status', r'where is my order #?\\d+', priority=10)
+
+        match = matcher.match(event.message['text'])
+        if match and match.intent == 'greeting':
+            ...
+    """
+    def __init__(self):
+        self.keywords = []
+        self.patterns = []
+        self.compiled = False
+
+    def keyword(self, intent, keywords, priority=0):
+        """keyword
+
+        Adds a rule matching any of the given keywords (a string or a list of strings).
+        """
+        if not isinstance(keywords, (list, tuple, set)):
+            keywords = [keywords]
+        for keyword in keywords:
+            keyword = normalize(keyword)
+            if keyword:
+                self.keywords.append((keyword, intent, priority))
+        self.compiled = False
+
+    def regex(self, intent, pattern, priority=0):
+        """regex
+
+        Adds a rule matching the given regular expression.
+        """
+        re.compile(pattern)
+        self.patterns.append((pattern, intent, priority))
+        self.compiled = False
+
+    def compile(self):
+        self.automaton = KeywordAutomaton()
+        for keyword, intent, priority in self.keywords:
+            self.automaton.add(keyword, (intent, priority))
+        self.automaton.build()
+
+        # One alternation per priority tier, highest first. A tier can't hide the matches of
+        # another one, and lower tiers are only searched when higher ones don't match
+        tiers = {}
+        for pattern, intent, priority in self.patterns:
+            tiers.setdefault(priority, []).append((pattern, intent))
+        self.regexes = []
+        for priority in sorted(tiers, reverse=True):
+            patterns = tiers[priority]
+            chunks = []
+            for i in range(0, len(patterns), MAX_GROUPS_PER_PATTERN):
+                chunk = patterns[i:i + MAX_GROUPS_PER_PATTERN]
+                groups = [('_%d' % j, intent) for j, (_, intent) in enumerate(chunk)]
+                regex = re.compile('|'.join(
+                    '(?P<%s>%s)' % (name, pattern) for (name, _), (pattern, _) in zip(groups, chunk)
+                ), re.UNICODE)
+                chunks.append((regex, groups))
+            self.regexes.append((priority, chunks))
+
+        self.compiled = True
+
+    def is_word_boundary(self, text, start, end):
+        return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+    def match(self, text):
+        """match
+
+        Returns the IntentMatch of the highest priority rule matching text, or None.
+        """
+        if not self.compiled:
+            self.compile()
+
+        text = normalize(text or '')
+        best = None
+
+        for start, end, (intent, priority) in self.automaton.search(text):
+            if self.is_word_boundary(text, start, end):
+                match = IntentMatch(intent, priority, start, end)
+                if match.beats(best):
+                    best = match
+
+        for priority, chunks in self.regexes:
+            if best is not None and priority < best.priority:
+                break
+            for regex, groups in chunks:
+                m = regex.search(text)
+                if m is None:
+                    continue
+                for name, intent in groups:
+                    if m.start(name) != -1:
+                        match = IntentMatch(intent, priority, m.start(), m.end())
+                        if match.beats(best):
+                            best = match
+                        break
+
+        return best
@@ -1,6 +1,37 @@
 from datetime import datetime
+import heapq
 import json
-from ..models import BotMessage
+import logging
+import time
+import traceback
+
+from django.conf import settings
+from django.db import (
+    DatabaseError,
+    IntegrityError,
+    transaction,
+)
+from messenger import Webhook
+
+from ..models import (
+    BotMessage,
+    BotWatermark,
+)
+from .archive import MessageArchive
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+
+def keyed(bms, source):
+    # (timestamp, id) merge keys, source breaks ties so messages are never compared
+    for bm in bms:
+        yield (bm.timestamp, bm.id, source), bm
+
+
+def latest(*datetimes):
+    datetimes = [dt for dt in datetimes if dt is not None]
+    return max(datetimes) if datetimes else None
 
 
 class MessageLogger(object):
@@ -26,16 +57,103 @@ class MessageLogger(object):
         params['timestamp__lte'] = timestamp
         return BotMessage.objects.filter(**params)
 
-    def create_bot_message(self, event, payload):
+    def iter_bot_messages(self, start=None, end=None, bot_id=None):
+        """iter_bot_messages
+
+        Iterates over the messages between start and end, oldest first by (timestamp, id),
+        wherever they are stored. Months sealed into the archive (see MessageArchive) are read
+        from their segments, the rest from the BotMessage table.
+
+        Months before the archive boundary stay in the table until they're sealed, so both are
+        merged. A month whose sealing was interrupted can be in both, its messages are only
+        returned once.
+        """
+        params = {}
+        if bot_id is not None:
+            params['bot_id'] = bot_id
+        if start is not None:
+            params['timestamp__gte'] = start
+        if end is not None:
+            params['timestamp__lt'] = end
+        table = BotMessage.objects.filter(**params).order_by('timestamp', 'id').iterator()
+
+        if not settings.BOT_MESSAGE_ARCHIVE_DIR:
+            for bm in table:
+                yield bm
+            return
+
+        archive = MessageArchive()
+        boundary = archive.boundary
+        if start is not None and start >= boundary:
+            for bm in table:
+                yield bm
+            return
+
+        archive_end = boundary if end is None else min(end, boundary)
+        archived = archive.messages(start=start, end=archive_end, bot_id=bot_id)
+
+        last = None
+        for key, bm in heapq.merge(keyed(archived, 0), keyed(table, 1)):
+            if key[:2] == last:
+                continue
+            last = key[:2]
+            yield bm
+
+    def build_bot_message(self, event, payload):
         received = not event.is_echo
         bot_id = event.sender.id if received else event.recipient.id
 
-        return BotMessage.objects.create(
+        # mid and seq are in the message or postback object
+        messaging = payload.get('message') or payload.get('postback') or {}
+
+        bm = BotMessage(
             bot_id=bot_id,
             timestamp=event.timestamp,
+            mid=messaging.get('mid'),
+            seq=messaging.get('seq'),
             received=received,
-            payload=json.dumps(payload),
         )
+        bm.set_payload(payload)
+        return bm
+
+    def save_bot_message(self, bm):
+        """save_bot_message
+
+        Inserts a BotMessage unless one with the same mid already exists, which happens when
+        a log task is retried. In that case the existing one is returned.
+        """
+        try:
+            with transaction.atomic():
+                bm.save(force_insert=True)
+            return bm
+        except IntegrityError:
+            if bm.mid is None:
+                raise
+            return self.get_bot_message(bm.mid)
+
+    def create_bot_message(self, event, payload):
+        bm = self.build_bot_message(event, payload)
+        return self.save_bot_message(bm)
+
+    @property
+    def use_watermarks(self):
+        return settings.BOT_MESSAGE_RECEIPTS == 'watermark'
+
+    def log_payload(self, data):
+        """log_payload
+
+        Logs every message event of a webhook payload.
+
+        Parameters
+        ----------
+        data: string
+            the json webhook payload
+        """
+        wh = Webhook(json.loads(data))
+        for entry in wh.entries:
+            for event in entry.messaging:
+                with span('logger.log', sender=event.sender.id):
+                    self.log(event)
 
     def log(self, event):
         """log
@@ -43,13 +161,13 @@ class MessageLogger(object):
         Master log function.
         """
         if event.is_message:
-            self.log_message(event)
+            return self.log_message(event)
         elif event.is_postback:
-            self.log_postback(event)
+            return self.log_postback(event)
         elif event.is_delivery:
-            self.log_delivery(event)
+            return self.log_delivery(event)
         elif event.is_read:
-            self.log_read(event)
+            return self.log_read(event)
 
     def log_message(self, event):
         """log_message
@@ -57,7 +175,7 @@ class MessageLogger(object):
         Logs a message event.
         """
         payload = {'message': event.message}
-        self.create_bot_message(event, payload)
+        return self.create_bot_message(event, payload)
 
     def log_postback(self, event):
         """log_postback
@@ -65,33 +183,48 @@ class MessageLogger(object):
         Logs a postback event.
         """
         payload = {'postback': event.postback}
-        self.create_bot_message(event, payload)
+        return self.create_bot_message(event, payload)
 
     def log_delivery(self, event):
-        """log_read
+        """log_delivery
+
+        Logs a delivery event by setting the delivery times of all messages upto the watermark
+        timestamp in a single UPDATE, or by advancing the user's delivered watermark if
+        BOT_MESSAGE_RECEIPTS is 'watermark'.
 
-        Logs a delivery event by getting all messages upto watermark timestamp and
-        setting their delivery times.
+        Returns
+        -------
+        count: int
+            number of messages marked as delivered, None for watermarks
         """
         watermark = datetime.utcfromtimestamp(event.delivery['watermark']/1000)
+        if self.use_watermarks:
+            return self.log_watermark(event.sender.id, delivered=watermark)
+
         params = {
             'bot_id': event.sender.id,
             'received': False,
             'delivered_time__isnull': True,
         }
 
-        bms = self.get_bot_messages(watermark, params)
-        for bm in bms:
-            bm.delivered_time = watermark
-            bm.save()
+        return self.get_bot_messages(watermark, params).update(delivered_time=watermark)
 
     def log_read(self, event):
         """log_read
 
-        Logs a read event by getting all messages upto watermark timestamp and
-        setting their read times.
+        Logs a read event by setting the read times of all messages upto the watermark
+        timestamp in a single UPDATE, or by advancing the user's read watermark if
+        BOT_MESSAGE_RECEIPTS is 'watermark'.
+
+        Returns
+        -------
+        count: int
+            number of messages marked as read, None for watermarks
         """
         watermark = datetime.utcfromtimestamp(event.read['watermark']/1000)
+        if self.use_watermarks:
+            return self.log_watermark(event.sender.id, read=watermark)
+
         params = {
             'bot_id': event.sender.id,
             'received': False,
@@ -99,7 +232,134 @@ class MessageLogger(object):
             'read_time__isnull': True,
         }
 
-        bms = self.get_bot_messages(watermark, params)
+        return self.get_bot_messages(watermark, params).update(read_time=watermark)
+
+    def log_watermark(self, bot_id, delivered=None, read=None):
+        """log_watermark
+
+        Advances the delivered and/or read watermarks of a user.
+        """
+        BotWatermark.advance(bot_id, delivered=delivered, read=read)
+
+
+class BufferedMessageLogger(MessageLogger):
+    """BufferedMessageLogger
+
+    Class for logging messages with buffered bulk inserts.
+
+    Messages are collected and written with a single bulk_create in one transaction. The buffer
+    is flushed when it holds max_size messages, when its oldest message is older than max_age
+    seconds, before any update of message receipts (so that the update sees the messages) and
+    when the logger is used as a context manager and the block exits:
+
+        with BufferedMessageLogger() as mlogger:
+            for event in events:
+                mlogger.log(event)
+
+    Messages whose mid is already logged are skipped. If the bulk insert fails, the messages are
+    inserted one by one so that a single bad message doesn't lose the rest of the batch.
+
+    If BOT_MESSAGE_RECEIPTS is 'watermark', receipts are buffered too and the receipts of a user
+    are coalesced into a single watermark update on flush.
+    """
+    def __init__(self, max_size=None, max_age=None):
+        self.max_size = max_size or settings.BOT_MESSAGE_BUFFER_SIZE
+        self.max_age = settings.BOT_MESSAGE_BUFFER_AGE if max_age is None else max_age
+        self.buffer = []
+        self.buffered_at = None
+        self.watermarks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+    def create_bot_message(self, event, payload):
+        bm = self.build_bot_message(event, payload)
+        if not self.buffer:
+            self.buffered_at = time.time()
+        self.buffer.append(bm)
+
+        if len(self.buffer) >= self.max_size or time.time() - self.buffered_at >= self.max_age:
+            self.flush()
+        return bm
+
+    def flush(self):
+        """flush
+
+        Writes the buffered messages and watermarks.
+
+        Returns
+        -------
+        count: int
+            number of messages written
+        """
+        with span('logger.flush'):
+            return self.write_buffer()
+
+    def write_buffer(self):
+        watermarks, self.watermarks = self.watermarks, {}
+        for bot_id, (delivered, read) in watermarks.items():
+            BotWatermark.advance(bot_id, delivered=delivered, read=read)
+
+        bms, self.buffer = self.buffer, []
+        bms = self.exclude_logged(bms)
+        if not bms:
+            return 0
+
+        try:
+            with transaction.atomic():
+                BotMessage.objects.bulk_create(bms)
+            return len(bms)
+        except DatabaseError:
+            logger.warning("Bulk insert of %d messages failed, inserting one by one", len(bms))
+
+        count = 0
+        for bm in bms:
+            try:
+                self.save_bot_message(bm)
+                count += 1
+            except DatabaseError:
+                logger.error(traceback.format_exc())
+        return count
+
+    def exclude_logged(self, bms):
+        """exclude_logged
+
+        Drops messages whose mid is duplicated in the batch or already logged.
+        """
+        mids = set(bm.mid for bm in bms if bm.mid is not None)
+        if not mids:
+            return bms
+
+        seen = set(BotMessage.objects.filter(mid__in=mids).values_list('mid', flat=True))
+        unlogged = []
         for bm in bms:
-            bm.read_time = watermark
-            bm.save()
+            if bm.mid is not None:
+                if bm.mid in seen:
+                    continue
+                seen.add(bm.mid)
+            unlogged.append(bm)
+        return unlogged
+
+    def log_delivery(self, event):
+        if not self.use_watermarks:
+            self.flush()
+        return super(BufferedMessageLogger, self).log_delivery(event)
+
+    def log_read(self, event):
+        if not self.use_watermarks:
+            self.flush()
+        return super(BufferedMessageLogger, self).log_read(event)
+
+    def log_watermark(self, bot_id, delivered=None, read=None):
+        """log_watermark
+
+        Buffers the watermarks of a user, keeping the latest ones.
+        """
+        buffered_delivered, buffered_read = self.watermarks.get(bot_id, (None, None))
+        self.watermarks[bot_id] = (
+            latest(delivered, buffered_delivered),
+            latest(read, buffered_read),
+        )
@@ -0,0 +1,145 @@
+from collections import deque
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+import traceback
+
+from django.db import close_old_connections
+
+from ..routers import (
+    read_your_writes,
+    reads_primary,
+    use_primary,
+)
+from .trace import (
+    continue_span,
+    current_span,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def nothing():
+    yield
+
+
+class Batch(object):
+    """Batch
+
+    Groups submitted to a GroupPool together, with the trace and database routing of the
+    submitting thread.
+    """
+    def __init__(self, func, keys):
+        self.func = func
+        self.keys = keys
+        self.finished = set()
+        self.cancelled = False
+        self.done = threading.Condition()
+        self.parent = current_span()
+        self.primary = reads_primary()
+
+    def finish(self, key):
+        with self.done:
+            self.finished.add(key)
+            if len(self.finished) == len(self.keys):
+                self.done.notify_all()
+
+    def wait(self, timeout):
+        end = time.time() + timeout
+        with self.done:
+            while len(self.finished) < len(self.keys):
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.done.wait(remaining)
+            self.cancelled = True
+            return [key for key in self.keys if key not in self.finished]
+
+
+class GroupPool(object):
+    """GroupPool
+
+    Process wide pool of worker threads for running a function on groups of items
+    concurrently. Each group is handled by a single call, so its items keep their order, while
+    different groups run at once.
+
+    The threads live as long as the process and keep their database connections between groups,
+    so CONN_MAX_AGE applies to them as to any other thread. They are started on first use, and
+    started again in a forked child, since threads don't survive a fork.
+
+    Groups run with the trace and database routing of the submitting thread, inside
+    read_your_writes(). Threads can't be interrupted, so the deadline of a batch stops its
+    groups from starting and stops waiting for those running, which finish in the background.
+    func should bound any blocking call, such as the timeout of the Messenger clients, or a hung
+    group holds its thread for good.
+
+        pool = GroupPool(threads=8)
+        unfinished = pool.run(handle_events, events_by_sender, deadline=10)
+
+    Parameters
+    ----------
+    threads: int
+        number of worker threads
+    """
+    def __init__(self, threads):
+        self.threads = threads
+        self.queue = deque()
+        self.ready = threading.Condition()
+        self.pid = None
+
+    def start(self):
+        with self.ready:
+            if self.pid == os.getpid():
+                return
+            self.queue.clear()
+            for _ in range(self.threads):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+            self.pid = os.getpid()
+
+    def run(self, func, groups, deadline):
+        """run
+
+        Runs func on each (key, items) of groups, an ordered dict or list of pairs, and waits up
+        to deadline seconds.
+
+        Returns
+        -------
+        unfinished: list
+            keys of the groups that didn't finish before the deadline
+        """
+        groups = list(groups.items() if hasattr(groups, 'items') else groups)
+        batch = Batch(func, [key for key, _ in groups])
+        if not groups:
+            return []
+
+        self.start()
+        with self.ready:
+            for key, items in groups:
+                self.queue.append((batch, key, items))
+            self.ready.notify_all()
+        return batch.wait(deadline)
+
+    def work(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                batch, key, items = self.queue.popleft()
+
+            if batch.cancelled:
+                continue
+
+            try:
+                with continue_span(batch.parent), read_your_writes(), use_primary() if batch.primary else nothing():
+                    batch.func(key, items)
+            except:
+                logger.error(traceback.format_exc())
+            finally:
+                # Connections are kept open up to CONN_MAX_AGE, unless unusable
+                close_old_connections()
+                batch.finish(key)
@@ -10,6 +10,8 @@ from messenger import (
     ThreadSettingsRequest
 )
 
+from .trace import span
+
 token = os.environ.get('PAGE_ACCESS_TOKEN')
 
 
@@ -86,4 +88,5 @@ class BotThreadPreparer(object):
         Applies thread settings to chat
         """
         client = MessengerClient(token)
-        return client.send(request)
+        with span('graph.send'):
+            return client.send(request)
@@ -0,0 +1,212 @@
+from datetime import timedelta
+from itertools import islice
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import BotMessage
+from ..routers import use_primary
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(object):
+    """RetentionPolicy
+
+    Describes which messages to keep. Messages older than max_age or beyond the max_count most
+    recent ones expire.
+
+    Parameters
+    ----------
+    max_age: timedelta
+        age after which messages expire
+
+    max_count: int
+        number of most recent messages to keep
+
+    bot_id: string
+        the user the policy applies to, or None to apply it to all messages
+    """
+    def __init__(self, max_age=None, max_count=None, bot_id=None):
+        if max_age is None and max_count is None:
+            raise ValueError('<RetentionPolicy> max_age or max_count must be set')
+
+        self.max_age = max_age
+        self.max_count = max_count
+        self.bot_id = bot_id
+
+    @classmethod
+    def from_config(cls, config):
+        """from_config
+
+        Creates a policy from an item of BOT_MESSAGE_RETENTION, e.g.
+            {'max_age_days': 90}
+            {'bot_id': '<BOT_ID>', 'max_count': 1000}
+        """
+        max_age = config.get('max_age_days')
+        return cls(
+            max_age=timedelta(days=max_age) if max_age is not None else None,
+            max_count=config.get('max_count'),
+            bot_id=config.get('bot_id'),
+        )
+
+    def __repr__(self):
+        return '<RetentionPolicy max_age=%s max_count=%s bot_id=%s>' % (
+            self.max_age, self.max_count, self.bot_id
+        )
+
+    @property
+    def queryset(self):
+        qs = BotMessage.objects.all()
+        if self.bot_id is not None:
+            qs = qs.filter(bot_id=self.bot_id)
+        return qs
+
+    def expired(self):
+        """expired
+
+        Returns the queryset of messages that the policy expires.
+        """
+        conditions = Q()
+        if self.max_age is not None:
+            conditions |= Q(timestamp__lt=timezone.now() - self.max_age)
+
+        if self.max_count is not None:
+            # (timestamp, id) of the most recent message past max_count
+            boundary = list(
+                self.queryset.order_by('-timestamp', '-id')
+                .values_list('timestamp', 'id')[self.max_count:self.max_count + 1]
+            )
+            if boundary:
+                timestamp, id = boundary[0]
+                conditions |= Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lte=id)
+
+        if not conditions:
+            return self.queryset.none()
+        return self.queryset.filter(conditions)
+
+
+class MessageCleaner(object):
+    """MessageCleaner
+
+    Class for deleting expired messages without locking the table for long.
+
+    Messages are deleted oldest first, in chunks of chunk_size, each in its own short
+    transaction, pausing between chunks so live inserts aren't stalled. Chunks are walked by
+    (timestamp, id) keyset rather than offset.
+
+    Parameters
+    ----------
+    chunk_size: int
+        messages deleted per transaction
+
+    pause: float
+        seconds to sleep between chunks
+
+    archiver: object with an archive(bms) method
+        if given, every chunk is archived before it's deleted (see NDJSONArchiver)
+
+    progress: callable
+        if given, called with the number of messages deleted so far after every chunk
+    """
+    def __init__(self, chunk_size=None, pause=None, archiver=None, progress=None):
+        self.chunk_size = chunk_size or settings.BOT_MESSAGE_RETENTION_CHUNK_SIZE
+        self.pause = settings.BOT_MESSAGE_RETENTION_PAUSE if pause is None else pause
+        self.archiver = archiver
+        self.progress = progress
+
+    def clean(self, policy):
+        """clean
+
+        Deletes the messages expired by the given policy.
+
+        Returns
+        -------
+        count: int
+            number of messages deleted
+        """
+        with use_primary():
+            count = self.purge(policy.expired())
+            logger.info("%r deleted %d messages", policy, count)
+            return count
+
+    def purge(self, qs):
+        """purge
+
+        Deletes the messages of a queryset chunk by chunk.
+
+        Returns
+        -------
+        count: int
+            number of messages deleted
+        """
+        # Chunks are walked right after deleting the previous ones, a lagging replica would return them again
+        with use_primary():
+            qs = qs.order_by('timestamp', 'id')
+            if not self.archiver:
+                qs = qs.only('id', 'timestamp')
+
+            count = 0
+            last = None
+            while True:
+                chunk_qs = qs
+                if last is not None:
+                    timestamp, id = last
+                    chunk_qs = qs.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=id))
+
+                chunk = list(chunk_qs[:self.chunk_size])
+                if not chunk:
+                    break
+
+                if self.archiver:
+                    self.archiver.archive(chunk)
+
+                with transaction.atomic():
+                    deleted, _ = BotMessage.objects.filter(id__in=[bm.id for bm in chunk]).delete()
+
+                count += deleted
+                last = (chunk[-1].timestamp, chunk[-1].id)
+                if self.progress:
+                    self.progress(count)
+                logger.debug("Deleted %d messages so far", count)
+
+                if len(chunk) < self.chunk_size:
+                    break
+                time.sleep(self.pause)
+
+            return count
+
+    def purge_ids(self, ids):
+        """purge_ids
+
+        Deletes the messages of the given ids, any iterable, chunk by chunk.
+
+        Returns
+        -------
+        count: int
+            number of messages deleted
+        """
+        ids = iter(ids)
+        count = 0
+        while True:
+            chunk = list(islice(ids, self.chunk_size))
+            if not chunk:
+                break
+
+            with transaction.atomic():
+                deleted, _ = BotMessage.objects.filter(id__in=chunk).delete()
+
+            count += deleted
+            if self.progress:
+                self.progress(count)
+            logger.debug("Deleted %d messages so far", count)
+
+            if len(chunk) < self.chunk_size:
+                break
+            time.sleep(self.pause)
+
+        return count
@@ -0,0 +1,94 @@
+from collections import Counter
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PostbackRouter(object):
+    """PostbackRouter
+
+    Class for dispatching postbacks to handler functions by their payload.
+
+    Payloads are of the form name,arg1,arg2,... (e.g. 'get_started,' or 'menu_item,5', see
+    BotThreadPreparer). Routes are registered by name with the converters of their arguments:
+
+        postback_router = PostbackRouter()
+
+        @postback_router.route('menu_item', int)
+        def menu_item(handler, event, item_id):
+            return Message(text="You picked item %d" % item_id)
+
+    Routes are looked up by name in a dict, so dispatching costs the same no matter how many
+    routes there are. Payloads that match no route, or whose arguments don't convert, are
+    counted in unmatched by name.
+
+    Parameters
+    ----------
+    separator: string
+        separator of the name and arguments in payloads
+    """
+    def __init__(self, separator=','):
+        self.separator = separator
+        self.routes = {}
+        self.unmatched = Counter()
+        self.lock = threading.Lock()
+
+    def route(self, name, *converters):
+        """route
+
+        Decorator registering a handler function for payloads with the given name. The function
+        is called with the handler, the event and the converted arguments.
+        """
+        if self.separator in name:
+            raise ValueError('<PostbackRouter> route name cannot contain %r' % self.separator)
+
+        def decorator(f):
+            if name in self.routes:
+                raise ValueError('<PostbackRouter> route %r is already registered' % name)
+            self.routes[name] = (f, converters)
+            return f
+        return decorator
+
+    def parse(self, payload):
+        """parse
+
+        Returns the handler function and converted arguments of a payload, or None if it doesn't
+        match any route.
+        """
+        name, _, rest = payload.partition(self.separator)
+        route = self.routes.get(name)
+        if route is None:
+            return None
+
+        f, converters = route
+        args = rest.split(self.separator) if rest else []
+        if len(args) != len(converters):
+            return None
+
+        try:
+            return f, [convert(arg) for convert, arg in zip(converters, args)]
+        except ValueError:
+            return None
+
+    def dispatch(self, handler, event):
+        """dispatch
+
+        Calls the handler function of a postback event.
+
+        Returns
+        -------
+        message: Message object, list of Message objects or None
+            what the handler function returns, None if the payload didn't match
+        """
+        payload = event.postback.get('payload', '')
+        match = self.parse(payload)
+        if match is None:
+            name = payload.partition(self.separator)[0]
+            with self.lock:
+                self.unmatched[name] += 1
+            logger.warning("Unmatched postback payload %r", payload)
+            return None
+
+        f, args = match
+        return f(handler, event, *args)
@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import (
+    connections,
+    router,
+)
+from django.db.models import (
+    Case,
+    IntegerField,
+    Q,
+    Value,
+    When,
+)
+
+from ..models import BotUser
+from .text import normalize
+
+# Whether each database has pg_trgm, by alias
+_trigrams = {}
+
+
+def prefix_match(field, prefix, vendor):
+    """prefix_match
+
+    Matches values of a field starting with prefix, in a way the database can serve from the
+    field's index.
+
+    On SQLite, LIKE doesn't use indexes, so the prefix is matched as a range, which is correct
+    under its default binary collation. Elsewhere ranges depend on the collation, e.g. glibc
+    locales ignore spaces and punctuation, so LIKE is used: Postgres serves it from the
+    varchar_pattern_ops index Django creates for indexed CharFields.
+    """
+    if vendor == 'sqlite':
+        return Q(**{field + '__gte': prefix, field + '__lt': prefix + '\uffff'})
+    return Q(**{field + '__startswith': prefix})
+
+
+def has_trigrams(using):
+    """has_trigrams
+
+    Whether the Postgres database of alias using has the pg_trgm extension, which create_indexes
+    can fail to enable. Looked up once per process.
+    """
+    if using not in _trigrams:
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigrams[using] = cursor.fetchone() is not None
+    return _trigrams[using]
+
+
+def search_bot_users(query, page=1, page_size=None):
+    """search_bot_users
+
+    Searches users by name.
+
+    Matches users whose full name or last name starts with the query and, on Postgres with
+    pg_trgm, whose full name is similar to it by trigrams. Names and the query are normalized first, so the
+    search ignores case and accents. Results are ranked exact match first, then full name
+    prefix, then last name prefix, then by similarity.
+
+    Parameters
+    ----------
+    query: string
+        name, or beginning of a name, to search for
+
+    page: int
+        1 based page number
+
+    page_size: int
+        users per page, defaults to BOT_USER_SEARCH_PAGE_SIZE
+
+    Returns
+    -------
+    bot_users: list of BotUser objects
+        the matching users of the page
+    """
+    query = normalize(query)
+    if not query:
+        return []
+
+    page_size = page_size or settings.BOT_USER_SEARCH_PAGE_SIZE
+    offset = (max(page, 1) - 1) * page_size
+
+    using = router.db_for_read(BotUser)
+    vendor = connections[using].vendor
+    matches = prefix_match('_search_name', query, vendor) | prefix_match('_search_last_name', query, vendor)
+    bot_users = BotUser.objects.annotate(rank=Case(
+        When(_search_name=query, then=Value(3)),
+        When(_search_name__startswith=query, then=Value(2)),
+        When(_search_last_name__startswith=query, then=Value(1)),
+        default=Value(0),
+        output_field=IntegerField(),
+    ))
+
+    ordering = ['-rank']
+    if vendor == 'postgresql' and has_trigrams(using):
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        matches |= Q(_search_name__trigram_similar=query)
+        bot_users = bot_users.annotate(similarity=TrigramSimilarity('_search_name', query))
+        ordering.append('-similarity')
+
+    ordering.append('_search_name')
+    return list(bot_users.filter(matches).order_by(*ordering)[offset:offset + page_size])
@@ -0,0 +1,284 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import (
+    IntegrityError,
+    transaction,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ..models import BotConversationState
+
+ANY = '*'
+
+# Backends whose cache isn't shared between processes
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def cache_is_shared():
+    return settings.CACHES['default']['BACKEND'] not in LOCAL_CACHE_BACKENDS
+
+
+class StateConflict(Exception):
+    """StateConflict
+
+    Raised when a conversation was changed concurrently, by another event of the same user,
+    since it was loaded. Load it again and retry.
+    """
+    pass
+
+
+class InvalidTransition(Exception):
+    """InvalidTransition
+
+    Raised when a trigger has no transition from the current state of a conversation.
+    """
+    pass
+
+
+class Conversation(object):
+    """Conversation
+
+    Snapshot of the conversation state of a user.
+
+    Attributes
+    ----------
+    bot_id: string
+        the user's bot id
+
+    state: string
+        the current state
+
+    data: dict
+        json serializable data gathered along the conversation
+
+    version: int
+        incremented on every change, for detecting concurrent changes
+
+    updated_at: datetime
+        time of the last change
+    """
+    def __init__(self, bot_id, state, data=None, version=0, updated_at=None):
+        self.bot_id = bot_id
+        self.state = state
+        self.data = data or {}
+        self.version = version
+        self.updated_at = updated_at
+
+    def __repr__(self):
+        return '<Conversation %s state=%s version=%d>' % (self.bot_id, self.state, self.version)
+
+    def serialize(self):
+        return {
+            'state': self.state,
+            'data': self.data,
+            'version': self.version,
+            'updated_at': self.updated_at.isoformat(),
+        }
+
+    @classmethod
+    def deserialize(cls, bot_id, data):
+        return cls(bot_id, data['state'], data['data'], data['version'], parse_datetime(data['updated_at']))
+
+
+class StateMachine(object):
+    """StateMachine
+
+    Class for declaring the states and transitions of multi-step conversations, and keeping
+    the conversation state of each user.
+
+    States are kept in the default cache under bot_state:<bot_id> and written behind to
+    BotConversationState by the persist_conversation_state task, at most once every
+    BOT_CONVERSATION_STATE_PERSIST_DELAY seconds per user. Conversations untouched for
+    BOT_CONVERSATION_STATE_TTL seconds expire back to the initial state.
+
+    Every change increments the conversation version. A change made from a stale version, such
+    as two events of the same user handled at once, raises StateConflict.
+
+    A cache local to each process can't hold states for the others, so without a shared cache
+    (see CACHES in settings) states are read from and written to BotConversationState directly.
+
+        machine = StateMachine('idle')
+        machine.transition('order', 'idle', 'choosing')
+        machine.transition('choose', 'choosing', 'confirming')
+        machine.transition('cancel', ANY, 'idle')
+
+        conversation = machine.load(event.sender.id)
+        conversation = machine.fire(conversation, 'choose', item_id=3)
+
+    Parameters
+    ----------
+    initial: string
+        the state of new and expired conversations
+
+    ttl: int
+        seconds before an untouched conversation expires, BOT_CONVERSATION_STATE_TTL by default
+    """
+    claim_ttl = 60
+
+    def __init__(self, initial, ttl=None):
+        self.initial = initial
+        self.states = set([initial])
+        self.transitions = {}
+        self.ttl = ttl or settings.BOT_CONVERSATION_STATE_TTL
+
+    def transition(self, trigger, sources, dest):
+        """transition
+
+        Declares that trigger moves a conversation from any of sources (a state, a list of
+        states or ANY) to dest.
+        """
+        if not isinstance(sources, (list, tuple, set)):
+            sources = [sources]
+        for source in sources:
+            if source != ANY:
+                self.states.add(source)
+            self.transitions[(source, trigger)] = dest
+        self.states.add(dest)
+
+    def triggers(self, state):
+        """triggers
+
+        Returns the triggers with a transition from state.
+        """
+        return set(t for (s, t) in self.transitions if s in (state, ANY))
+
+    @classmethod
+    def key(cls, bot_id):
+        return 'bot_state:%s' % bot_id
+
+    def load(self, bot_id):
+        """load
+
+        Loads the conversation of a user from the cache, falling back to the database.
+        """
+        data = cache.get(self.key(bot_id)) if cache_is_shared() else None
+        if data is not None:
+            return Conversation.deserialize(bot_id, data)
+
+        try:
+            row = BotConversationState.objects.get(bot_id=bot_id)
+        except BotConversationState.DoesNotExist:
+            return Conversation(bot_id, self.initial)
+
+        if row.updated_at < timezone.now() - timedelta(seconds=self.ttl):
+            # Expired, versions carry on so the stored state is still replaced
+            return Conversation(bot_id, self.initial, version=row.version)
+        return Conversation(bot_id, row.state, row.data, row.version, row.updated_at)
+
+    def save(self, conversation, state, data):
+        """save
+
+        Saves a new state of a conversation and returns it.
+
+        Versions are claimed with cache.add, which is atomic, so only one change can be made
+        from any given version. Claims only need to outlive concurrent events, changes from an
+        older version are caught by comparing with the cached one.
+        """
+        if not cache_is_shared():
+            return self.save_to_db(conversation, state, data)
+
+        key = self.key(conversation.bot_id)
+        cached = cache.get(key)
+        if cached is not None and cached['version'] != conversation.version:
+            raise StateConflict(conversation.bot_id)
+
+        version = conversation.version + 1
+        if not cache.add('%s:%d' % (key, version), True, self.claim_ttl):
+            raise StateConflict(conversation.bot_id)
+
+        conversation = Conversation(conversation.bot_id, state, data, version, timezone.now())
+        cache.set(key, conversation.serialize(), self.ttl)
+        self.schedule_persist(conversation.bot_id)
+        return conversation
+
+    def save_to_db(self, conversation, state, data):
+        """save_to_db
+
+        Saves a new state of a conversation straight to the database and returns it, when the
+        cache isn't shared. The version is checked by the UPDATE itself.
+        """
+        new = Conversation(conversation.bot_id, state, data, conversation.version + 1, timezone.now())
+        fields = {'state': new.state, 'data': new.data, 'version': new.version, 'updated_at': new.updated_at}
+        qs = BotConversationState.objects.filter(bot_id=new.bot_id)
+        if qs.filter(version=conversation.version).update(**fields):
+            return new
+
+        try:
+            with transaction.atomic():
+                BotConversationState.objects.create(bot_id=new.bot_id, **fields)
+        except IntegrityError:
+            # Changed or created concurrently
+            raise StateConflict(conversation.bot_id)
+        return new
+
+    @classmethod
+    def schedule_persist(cls, bot_id):
+        # Imported here, tasks imports this module
+        from ..tasks import persist_conversation_state
+
+        delay = settings.BOT_CONVERSATION_STATE_PERSIST_DELAY
+        if cache.add('bot_state_persist:%s' % bot_id, True, delay):
+            persist_conversation_state.apply_async((bot_id,), countdown=delay)
+
+    @classmethod
+    def persist(cls, bot_id):
+        """persist
+
+        Writes the cached conversation of a user to the database.
+        """
+        cache.delete('bot_state_persist:%s' % bot_id)
+        data = cache.get(cls.key(bot_id))
+        if data is not None:
+            conversation = Conversation.deserialize(bot_id, data)
+            BotConversationState.store(
+                bot_id, conversation.state, conversation.data, conversation.version, conversation.updated_at
+            )
+
+    def fire(self, conversation, trigger, **data):
+        """fire
+
+        Moves a conversation along the transition of trigger, updating its data with the given
+        keyword arguments, and returns it.
+        """
+        dest = self.transitions.get((conversation.state, trigger), self.transitions.get((ANY, trigger)))
+        if dest is None:
+            raise InvalidTransition('%s from %s' % (trigger, conversation.state))
+
+        new_data = dict(conversation.data)
+        new_data.update(data)
+        return self.save(conversation, dest, new_data)
+
+    def update(self, conversation, **data):
+        """update
+
+        Updates the data of a conversation without changing its state, and returns it.
+        """
+        new_data = dict(conversation.data)
+        new_data.update(data)
+        return self.save(conversation, conversation.state, new_data)
+
+    def reset(self, conversation):
+        """reset
+
+        Moves a conversation back to the initial state with no data, and returns it.
+        """
+        return self.save(conversation, self.initial, {})
+
+    @classmethod
+    def expire(cls, ttl=None):
+        """expire
+
+        Deletes the stored conversations untouched for ttl seconds.
+        """
+        ttl = ttl or settings.BOT_CONVERSATION_STATE_TTL
+        return BotConversationState.objects.filter(
+            updated_at__lt=timezone.now() - timedelta(seconds=ttl)
+        ).delete()
@@ -0,0 +1,16 @@
+from __future__ import unicode_literals
+
+import unicodedata
+
+from django.utils.encoding import force_text
+
+
+def normalize(text):
+    """normalize
+
+    Normalizes text for matching: lowercases it, strips accents and collapses whitespace. Byte
+    strings are decoded as utf-8 first.
+    """
+    text = unicodedata.normalize('NFKD', force_text(text))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.lower().split())
@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+_state = threading.local()
+
+
+def new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Span(object):
+    """Span
+
+    A timed stage of the work on a trace.
+
+    Attributes
+    ----------
+    trace_id: string
+        id shared by all spans of a trace
+
+    span_id: string
+        id of the span
+
+    parent_id: string
+        id of the parent span, or None for the root span
+
+    name: string
+        name of the stage, e.g. 'webhook' or 'graph.send'
+
+    start, end: float
+        epoch times in seconds
+
+    tags: dict
+        additional information about the span
+    """
+    def __init__(self, name, trace_id=None, parent_id=None, start=None, **tags):
+        self.name = name
+        self.trace_id = trace_id or new_id()
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.tags = tags
+
+    @property
+    def duration(self):
+        return self.end - self.start if self.end is not None else None
+
+    def finish(self, end=None):
+        self.end = time.time() if end is None else end
+        if exporter is not None:
+            exporter.export(self)
+
+    def serialize(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'tags': self.tags,
+        }
+
+
+class FileExporter(object):
+    """FileExporter
+
+    Appends finished spans to a file as newline delimited json, one span per line.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.serialize()).encode('utf-8') + b'\n'
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+exporter = FileExporter(settings.BOT_TRACE_FILE) if settings.BOT_TRACE_FILE else None
+
+
+def current_span():
+    return getattr(_state, 'span', None)
+
+
+@contextmanager
+def span(name, trace_id=None, parent_id=None, **tags):
+    """span
+
+    Times the block as a span. The span is a child of the current span of the thread, or of
+    trace_id and parent_id if given, and is the current span within the block.
+    """
+    parent = current_span()
+    if trace_id is None and parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+
+    s = Span(name, trace_id=trace_id, parent_id=parent_id, **tags)
+    _state.span = s
+    try:
+        yield s
+    finally:
+        _state.span = parent
+        s.finish()
+
+
+@contextmanager
+def continue_span(parent):
+    """continue_span
+
+    Makes parent the current span within the block, e.g. to carry a trace into another thread.
+    """
+    previous = current_span()
+    _state.span = parent
+    try:
+        yield
+    finally:
+        _state.span = previous
+
+
+def task_headers():
+    """task_headers
+
+    Celery task headers carrying the current trace, pass them to apply_async(headers=...).
+    """
+    s = current_span()
+    if s is None:
+        return {}
+    return {'trace_id': s.trace_id, 'trace_parent_id': s.span_id, 'trace_sent_at': time.time()}
+
+
+@contextmanager
+def task_span(name, request, **tags):
+    """task_span
+
+    Times a celery task as a span continuing the trace of its task_headers(), and records the
+    time the task spent in the broker as a 'broker' span.
+    """
+    def header(key):
+        # Depending on the celery version, custom headers end up on the request or its headers
+        value = getattr(request, key, None)
+        if value is None:
+            value = (getattr(request, 'headers', None) or {}).get(key)
+        return value
+
+    trace_id, parent_id, sent_at = header('trace_id'), header('trace_parent_id'), header('trace_sent_at')
+    if trace_id is not None and sent_at is not None:
+        Span('broker', trace_id=trace_id, parent_id=parent_id, start=sent_at).finish()
+
+    with span(name, trace_id=trace_id, parent_id=parent_id, **tags) as s:
+        yield s
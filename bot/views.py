@@ -1,15 +1,31 @@
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.http import (
     HttpResponse,
+    HttpResponseBadRequest,
     HttpResponseForbidden,
+    JsonResponse,
 )
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 
 from .utils.verify import (
     verify_request,
     verify_token,
 )
-from .utils.handle import handle_payload
-from .tasks import log_payload
+from .utils.capture import SegmentWriter
+from .utils.history import ConversationHistory
+from .utils.trace import (
+    span,
+    task_headers,
+)
+from .tasks import (
+    handle_payload,
+    log_payload,
+)
+
+# Captures verified webhook requests for replay, see bot/management/commands/replay_webhooks.py
+capture_writer = SegmentWriter(settings.BOT_WEBHOOK_CAPTURE_DIR) if settings.BOT_WEBHOOK_CAPTURE_DIR else None
 
 
 @csrf_exempt
@@ -23,9 +39,13 @@ def webhook(request):
         if not verify_request(request):
             return HttpResponseForbidden("Request couldn't be verified.")
 
+        if capture_writer:
+            capture_writer.write(request.body, request.META.get('HTTP_X_HUB_SIGNATURE'))
+
         # Handle the message payload and log it asynchronously
-        handle_payload(request.body)
-        log_payload.apply_async((request.body,))
+        with span('webhook'):
+            handle_payload.apply_async((request.body,), headers=task_headers())
+            log_payload.apply_async((request.body,), headers=task_headers())
 
         # Notify success
         return HttpResponse("Request successful.")
@@ -37,3 +57,28 @@ def webhook(request):
 
         # Otherwise, user not allowed here
         return HttpResponseForbidden("You're not supposed to be here!")
+
+
+@staff_member_required
+@require_GET
+def history(request, bot_id):
+    """history
+
+    Returns a page of a user's conversation as json. Takes the optional query parameters:
+        before: cursor, returns the messages right before it
+        after: cursor, returns the messages right after it
+        limit: positive page size, capped at BOT_HISTORY_MAX_PAGE_SIZE
+    """
+    try:
+        limit = request.GET.get('limit')
+        limit = int(limit) if limit else None
+        if limit is not None and limit <= 0:
+            raise ValueError("limit must be positive")
+        page = ConversationHistory(bot_id, page_size=limit).page(
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+        )
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    return JsonResponse(page.serialize())
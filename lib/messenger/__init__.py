@@ -2,6 +2,10 @@ import requests
 
 GRAPH_API_URL = 'https://graph.facebook.com/v2.8'
 
+# Seconds to wait for the Graph API to connect and to respond, so a hung request can't hold
+# its thread forever
+TIMEOUT = 10
+
 
 class MessengerException(Exception):
     pass
@@ -18,8 +22,9 @@ class MessengerError(object):
 
 
 class MessengerClient(object):
-    def __init__(self, access_token):
+    def __init__(self, access_token, timeout=TIMEOUT):
         self.access_token = access_token
+        self.timeout = timeout
 
     def send(self, request):
         """
@@ -32,7 +37,8 @@ class MessengerClient(object):
         response = method(
             request.graph_api_endpoint,
             params=params,
-            json=request.to_dict()
+            json=request.to_dict(),
+            timeout=self.timeout
         )
         if response.status_code != 200:
             MessengerError(
@@ -3,6 +3,7 @@ import requests
 from .. import (
     MessengerError,
     GRAPH_API_URL,
+    TIMEOUT,
 )
 
 
@@ -14,16 +15,17 @@ class UserProfile(object):
                         'locale',
                         'timezone')
 
-    def __init__(self, access_token, user):
+    def __init__(self, access_token, user, timeout=TIMEOUT):
         self.access_token = access_token
         self.user = user
+        self.timeout = timeout
         self.populate_user_info()
 
     def populate_user_info(self):
         fields = ','.join(self.available_fields)
         url = '{}/{}'.format(GRAPH_API_URL, self.user.id)
         params = {'access_token': self.access_token, 'fields': fields}
-        response = requests.get(url, params=params)
+        response = requests.get(url, params=params, timeout=self.timeout)
         if response.status_code != 200:
             MessengerError(
                 **response.json()['error']
@@ -1,6 +1,10 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from kombu import (
+    Exchange,
+    Queue,
+)
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', '{{ project_name }}.settings')
@@ -9,6 +13,37 @@ app = Celery('{{ project_name }}')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks()
 
+# Task queues, from most to least latency critical. Each one is consumed by its own worker
+# process (see Procfile), so that a backlog in one doesn't delay the others and each can be
+# scaled on its own:
+#  - replies: handling of message events, which users are waiting on
+#  - logging: logging of message events
+#  - profiles: fetching of user profiles
+#  - state: writing conversation states behind the cache
+#  - maintenance: periodic tasks such as cleanups and rollups
+#
+# Within a queue, tasks with a higher priority (0-9) are consumed first.
+QUEUES = ('replies', 'logging', 'profiles', 'state', 'maintenance')
+
+app.conf.update(
+    CELERY_QUEUES=tuple(
+        Queue(name, Exchange(name), routing_key=name, queue_arguments={'x-max-priority': 9})
+        for name in QUEUES
+    ),
+    CELERY_DEFAULT_QUEUE='maintenance',
+    CELERY_ROUTES={
+        'handle_payload': {'queue': 'replies', 'priority': 9},
+        'log_payload': {'queue': 'logging', 'priority': 5},
+        'enrich_bot_user': {'queue': 'profiles', 'priority': 7},
+        'refresh_user_profiles': {'queue': 'profiles', 'priority': 1},
+        'persist_conversation_state': {'queue': 'state', 'priority': 5},
+        'expire_conversation_states': {'queue': 'maintenance', 'priority': 1},
+        'cleanup_messages': {'queue': 'maintenance', 'priority': 1},
+        'seal_message_partitions': {'queue': 'maintenance', 'priority': 1},
+        'rollup_messages': {'queue': 'maintenance', 'priority': 3},
+    },
+)
+
 
 @app.task(bind=True)
 def debug_task(self):
@@ -43,7 +43,7 @@ INSTALLED_APPS = [
     # http://whitenoise.evans.io/en/stable/django.html#using-whitenoise-in-development
     'whitenoise.runserver_nostatic',
     'django.contrib.staticfiles',
-    'bot',
+    'bot.apps.BotConfig',
 ]
 
 MIDDLEWARE_CLASSES = [
@@ -118,6 +118,31 @@ USE_TZ = True
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Postgres specific lookups, such as trigram similarity for user search
+if 'postgresql' in DATABASES['default']['ENGINE']:
+    INSTALLED_APPS.append('django.contrib.postgres')
+
+# Read replicas from $DATABASE_REPLICA_URLS (comma separated), see bot/routers.py
+DATABASE_REPLICAS = []
+for i, url in enumerate(u for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if u.strip()):
+    alias = 'replica%d' % i
+    DATABASES[alias] = dj_database_url.parse(url.strip(), conn_max_age=500)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['bot.routers.ReplicaRouter']
+DATABASE_REPLICA_MAX_LAG = 10  # Seconds a replica can lag behind before reads fall back to the primary
+DATABASE_REPLICA_CHECK_INTERVAL = 30  # Seconds between replica health checks
+
+# Cache shared by all processes with $REDIS_URL, otherwise each process has its own in memory
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        },
+    }
+
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
@@ -164,3 +189,43 @@ BROKER_CONNECTION_TIMEOUT = 30  # May require a long timeout due to Linux DNS ti
 CELERY_RESULT_BACKEND = None  # AMQP is not recommended as result backend as it creates thousands of queues
 CELERY_SEND_EVENTS = False  # Will not create celeryev.* queues
 CELERY_EVENT_QUEUE_EXPIRES = 60  # Will delete all celeryev. queues without consumers after 1 minute.
+CELERYD_PREFETCH_MULTIPLIER = int(os.environ.get('CELERYD_PREFETCH_MULTIPLIER', 4))  # Set per worker in Procfile
+# Task queues and routes are in {{ project_name }}/celery.py
+
+# Bot configuration
+BOT_USER_PROFILE_TTL = int(os.environ.get('BOT_USER_PROFILE_TTL', 7 * 24 * 60 * 60))  # Seconds before a profile snapshot is stale
+BOT_USER_PROFILE_BATCH_SIZE = 50  # Profile snapshots written per transaction
+BOT_USER_PROFILE_REFRESH_LIMIT = 1000  # Max profile snapshots refreshed per task run
+BOT_USER_PROFILE_BACKOFF = 60  # Seconds to wait after a first failed profile request
+BOT_USER_PROFILE_MAX_BACKOFF = 7 * 24 * 60 * 60  # Cap on the doubling profile backoff
+BOT_USER_PROFILE_MAX_FAILURES = 5  # Consecutive failures before a user is flagged unreachable
+BOT_MESSAGE_BUFFER_SIZE = 100  # Messages buffered by BufferedMessageLogger before a bulk insert
+BOT_MESSAGE_BUFFER_AGE = 5  # Seconds a message can stay buffered before a bulk insert
+BOT_MESSAGE_PAYLOAD_STORAGE = os.environ.get('BOT_MESSAGE_PAYLOAD_STORAGE', 'zlib')  # 'zlib' or 'json' (Postgres only)
+
+# Message retention, see RetentionPolicy in bot/utils/retention.py. Examples:
+#     {'max_age_days': 90}  # Delete all messages older than 90 days
+#     {'max_count': 100000}  # Keep the 100000 most recent messages
+#     {'bot_id': '<BOT_ID>', 'max_count': 1000}  # Keep a user's 1000 most recent messages
+BOT_MESSAGE_RETENTION = []
+BOT_MESSAGE_RETENTION_CHUNK_SIZE = 1000  # Messages deleted per transaction
+BOT_MESSAGE_RETENTION_PAUSE = 0.1  # Seconds to pause between deleted chunks
+BOT_MESSAGE_ARCHIVE_DIR = os.environ.get('BOT_MESSAGE_ARCHIVE_DIR')  # Archive messages here before deleting them
+BOT_MESSAGE_HOT_MONTHS = 3  # Months of messages kept in the table before being sealed into the archive
+BOT_HISTORY_PAGE_SIZE = 50  # Default messages per conversation history page
+BOT_HISTORY_MAX_PAGE_SIZE = 200  # Max messages per conversation history page
+BOT_MESSAGE_RECEIPTS = 'message'  # 'message' sets delivered/read times on each BotMessage, 'watermark' keeps per user BotWatermarks
+BOT_USER_CACHE_SIZE = 10000  # BotUsers kept in each process' identity cache
+BOT_USER_CACHE_TTL = 5 * 60  # Seconds before a cached BotUser is reloaded
+BOT_ROLLUP_BATCH_SIZE = 5000  # Messages rolled up per transaction
+BOT_ROLLUP_SETTLE = 60 * 60  # Seconds before a message is rolled up, so its receipts are in
+BOT_USER_SEARCH_PAGE_SIZE = 20  # Users per user search page
+BOT_WEBHOOK_CAPTURE_DIR = os.environ.get('BOT_WEBHOOK_CAPTURE_DIR')  # Capture webhook requests here for replay
+BOT_TRACE_FILE = os.environ.get('BOT_TRACE_FILE')  # Append timing spans of every stage here, see bot/utils/trace.py
+BOT_HANDLER_THREADS = 8  # Threads per process handling the senders of a webhook batch concurrently, 1 to handle them in sequence
+BOT_HANDLER_DEADLINE = 15  # Seconds to wait for the events of a webhook batch to be handled
+
+# Conversation states are kept in the cache when it's shared (see CACHES above), otherwise in
+# the database, see StateMachine in bot/utils/state.py
+BOT_CONVERSATION_STATE_TTL = 24 * 60 * 60  # Seconds before an untouched conversation expires
+BOT_CONVERSATION_STATE_PERSIST_DELAY = 30  # Seconds between writes of a conversation state to the database